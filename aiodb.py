@@ -0,0 +1,228 @@
+"""Асинхронний пул з'єднань PostgreSQL для marathon_bot_async.
+
+psycopg2 в асинхронному режимі (connect(async_=1) і poll()) не блокує потік на мережі: цикл подій лише
+чекає, поки сокет з'єднання стане готовим. Так асинхронний бот працює з тим самим драйвером і тими самими
+SQL-константами з db.py. Асинхронні з'єднання завжди в autocommit і не підтримують COPY, тож експорт
+виконується звичайним з'єднанням в окремому потоці.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _set_ready(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def wait(conn):
+    """Чекає, поки асинхронне з'єднання завершить поточну операцію; помилки запиту піднімає poll()."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+        fd = conn.fileno()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fd, _set_ready, ready)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fd, _set_ready, ready)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"unexpected poll state {state}")
+
+
+async def execute(pooled, query, params=None):
+    """Виконує запит і повертає курсор із готовим результатом."""
+    cur = pooled.conn.cursor()
+    cur.execute(query, params)
+    await wait(pooled.conn)
+    return cur
+
+
+class ConnectionPool:
+    """Обмежений пул асинхронних з'єднань з перевіркою стану та перепідключенням.
+
+    Семафор обмежує кількість виданих з'єднань; корутини, яким не вистачило з'єднання, чекають у черзі
+    семафора, а не займають потоки.
+    """
+
+    def __init__(self, dsn, minconn=db.DB_POOL_MIN, maxconn=db.DB_POOL_MAX,
+                 timeout=db.DB_POOL_TIMEOUT, healthcheck_interval=db.DB_HEALTHCHECK_INTERVAL):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxconn)
+        self._closed = False
+
+    async def _connect(self):
+        conn = psycopg2.connect(self.dsn, async_=1)
+        try:
+            await wait(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return db._PooledConnection(conn)
+
+    async def _is_alive(self, pooled):
+        if pooled.conn.closed:
+            return False
+        if time.monotonic() - pooled.last_used < self.healthcheck_interval:
+            return True
+        try:
+            (await execute(pooled, "SELECT 1")).close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(pooled):
+        try:
+            pooled.conn.close()
+        except psycopg2.Error:
+            pass
+
+    async def _acquire(self):
+        if self._closed:
+            raise psycopg2.InterfaceError("connection pool is closed")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise db.PoolTimeout(f"no free database connection after {self.timeout}s") from None
+        try:
+            while self._idle:
+                pooled = self._idle.pop()
+                if await self._is_alive(pooled):
+                    return pooled
+                logger.warning("Discarding broken PostgreSQL connection")
+                self._close_quietly(pooled)
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, pooled):
+        pooled.last_used = time.monotonic()
+        if self._closed:
+            self._close_quietly(pooled)
+        else:
+            self._idle.append(pooled)
+        self._slots.release()
+
+    def _discard(self, pooled):
+        self._close_quietly(pooled)
+        self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Видає з'єднання з пулу; обірване або перерване посеред запиту з'єднання не повертається до пулу."""
+        with metrics.DB_POOL_WAIT_SECONDS.time():
+            pooled = await self._acquire()
+        try:
+            yield pooled
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(pooled)
+            raise
+        except psycopg2.Error:
+            # Помилка запиту в autocommit не лишає відкритої транзакції
+            self._release(pooled)
+            raise
+        except BaseException:
+            # Скасована корутина могла залишити запит незавершеним
+            self._discard(pooled)
+            raise
+        else:
+            self._release(pooled)
+
+    async def warm_up(self):
+        """Відкриває minconn з'єднань заздалегідь, щоб перший фініш не чекав на handshake."""
+        opened = []
+        try:
+            for _ in range(self.minconn):
+                opened.append(await self._acquire())
+        finally:
+            for pooled in opened:
+                self._release(pooled)
+
+    def close(self):
+        self._closed = True
+        idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            self._close_quietly(pooled)
+
+
+async def prepare(pooled, name, statement):
+    """Готує серверний prepared statement один раз на з'єднання."""
+    if name not in pooled.prepared:
+        (await execute(pooled, statement)).close()
+        pooled.prepared.add(name)
+
+
+async def run_with_retry(pool, func, retries=1, operation=None):
+    """Виконує await func(pooled) і повторює спробу на новому з'єднанні, якщо старе обірвалося."""
+    with metrics.DB_SECONDS.time(operation or func.__name__):
+        for attempt in range(retries + 1):
+            try:
+                async with pool.connection() as pooled:
+                    return await func(pooled)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if attempt >= retries or isinstance(e, db.PoolTimeout):
+                    raise
+                logger.warning(f"Повторна спроба запиту до PostgreSQL після збою з'єднання: {e}")
+
+
+async def run_queries(pool, plan, *args):
+    """db.run_queries для асинхронного пулу: той самий план запитів, кожен запит чекає через wait()."""
+    async def run(pooled):
+        steps = plan(*args)
+        cur = pooled.conn.cursor()
+        try:
+            query, params = next(steps)
+            while True:
+                cur.execute(query, params)
+                await wait(pooled.conn)
+                query, params = steps.send(cur)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            cur.close()
+
+    return await run_with_retry(pool, run, operation=plan.__name__)
+
+
+async def save_results(pool, rows):
+    """Асинхронний відповідник db.save_results з тими самими запитами."""
+    async def upsert(pooled):
+        await prepare(pooled, db.UPSERT_STATEMENT, db.PREPARE_UPSERT)
+        (await execute(pooled, db.EXECUTE_UPSERT, rows[0])).close()
+
+    async def bulk_upsert(pooled):
+        cur = pooled.conn.cursor()
+        # Одна сторінка — один execute; асинхронне з'єднання не приймає наступного запиту до wait()
+        execute_values(cur, db.BULK_UPSERT, rows, page_size=len(rows))
+        await wait(pooled.conn)
+        cur.close()
+
+    await run_with_retry(pool, upsert if len(rows) == 1 else bulk_upsert)
@@ -0,0 +1,286 @@
+"""Персональні сертифікати учасників: ім'я, дистанція і час забігу на шаблоні події.
+
+Рендеринг (Pillow) виконується в пулі процесів, тож обробник оновлення лише ставить завдання, а пачка фінішів
+не займає GIL основного процесу. Шаблон і шрифти декодуються один раз у кожному процесі пулу і далі лише
+копіюються. Спільні для всіх учасників файли (CERTIFICATE_BADGE) завантажуються в Telegram один раз,
+після чого надсилаються за збереженим file_id.
+"""
+import asyncio
+import io
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+CERTIFICATE_TEMPLATE = os.environ.get('CERTIFICATE_TEMPLATE')  # PNG/JPEG фону; без нього — однотонне тло з рамкою
+CERTIFICATE_FONT = os.environ.get('CERTIFICATE_FONT', 'DejaVuSans.ttf')  # TTF з кирилицею, шукається і в системних шрифтах
+CERTIFICATE_BADGE = os.environ.get('CERTIFICATE_BADGE')  # спільне зображення (медаль), що надсилається після сертифіката
+# 0 вимикає сертифікати: після фінішу, як і раніше, надсилається лише посилання на сайт
+# Типово ядро лишається основному процесу бота
+CERTIFICATE_WORKERS = int(os.environ.get('CERTIFICATE_WORKERS', min(4, max(1, (os.cpu_count() or 1) - 1))))
+CERTIFICATE_SIZE = (1280, 905)  # альбомний A4, якщо шаблону немає; більші фото Telegram однаково зменшує до 1280
+CERTIFICATE_QUALITY = 90  # JPEG; Telegram однаково перекодовує фото
+CERTIFICATE_COLOR = '#1f3a68'
+CERTIFICATE_BACKGROUND = '#fdfbf3'
+CERTIFICATE_ACCENT = '#f5c400'
+
+# Рядки сертифіката: (частка висоти для центру рядка, частка висоти для розміру шрифту).
+# Перші CERTIFICATE_STATIC_LINES рядків однакові для всіх учасників однієї мови
+CERTIFICATE_LAYOUT = (
+    (0.22, 0.060),  # заголовок
+    (0.32, 0.040),  # назва марафону
+    (0.47, 0.080),  # ім'я
+    (0.60, 0.045),  # дистанція
+    (0.68, 0.045),  # час
+    (0.82, 0.030),  # дата
+)
+CERTIFICATE_STATIC_LINES = 2
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Ресурси процесу пулу: шаблон, шрифти за розміром і шаблони з уже намальованими спільними рядками
+_template = None
+_font_path = None
+_fonts = {}
+_bases = {}
+
+
+def _plain_template(size):
+    image = Image.new('RGB', size, CERTIFICATE_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    margin = height // 25
+    draw.rectangle((margin, margin, width - margin, height - margin), outline=CERTIFICATE_COLOR, width=margin // 3)
+    draw.rectangle((2 * margin, 2 * margin, width - 2 * margin, height - 2 * margin), outline=CERTIFICATE_ACCENT,
+                   width=margin // 6)
+    return image
+
+
+def _exit_with_parent(parent_pid):
+    # Після SIGKILL бота процес пулу не отримає EOF черги завдань: її кінці він успадкував через fork
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def _log_to_stderr():
+    # Черга логування бота тут лише копія, яку не читає жоден QueueListener: записи пишуться одразу в stderr
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+            stream = logging.StreamHandler()
+            stream.setFormatter(handler.formatter)
+            root.addHandler(stream)
+
+
+def _load_assets(template_path, font_path, parent_pid):
+    """Ініціалізатор процесу пулу: шаблон декодується тут один раз, а не на кожен сертифікат."""
+    global _template, _font_path
+    _log_to_stderr()
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+    if template_path:
+        with Image.open(template_path) as image:
+            _template = image.convert('RGB')
+    else:
+        _template = _plain_template(CERTIFICATE_SIZE)
+    _font_path = font_path
+    _fonts.clear()
+    _bases.clear()
+
+
+def _font(size):
+    font = _fonts.get(size)
+    if font is None:
+        font = ImageFont.truetype(_font_path, size) if _font_path else ImageFont.load_default(size)
+        _fonts[size] = font
+    return font
+
+
+def _draw_lines(image, lines, layout):
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    for text, (center, size) in zip(lines, layout):
+        if not text:
+            continue
+        size = round(height * size)
+        font = _font(size)
+        # Довге ім'я зменшується, щоб уміститися між рамками
+        text_width = draw.textlength(text, font=font)
+        if text_width > width * 0.8:
+            font = _font(max(8, int(size * width * 0.8 / text_width)))
+        draw.text((width / 2, height * center), text, font=font, fill=CERTIFICATE_COLOR, anchor='mm')
+
+
+def _render(lines):
+    """Малює рядки сертифіката на копії шаблону і повертає JPEG; виконується в процесі пулу."""
+    static = tuple(lines[:CERTIFICATE_STATIC_LINES])
+    base = _bases.get(static)
+    if base is None:
+        base = _template.copy()
+        _draw_lines(base, static, CERTIFICATE_LAYOUT)
+        _bases[static] = base
+    image = base.copy()
+    _draw_lines(image, lines[CERTIFICATE_STATIC_LINES:], CERTIFICATE_LAYOUT[CERTIFICATE_STATIC_LINES:])
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=CERTIFICATE_QUALITY)
+    return out.getvalue()
+
+
+def format_duration(start_time, finish_time):
+    """Час забігу H:MM:SS з рядків start_time і finish_time стану учасника; None, якщо його не порахувати."""
+    try:
+        seconds = int((datetime.strptime(finish_time, TIME_FORMAT) - datetime.strptime(start_time, TIME_FORMAT)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+    if seconds < 0:
+        return None
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def certificate_lines(state, texts, hidden_values=()):
+    """Рядки сертифіката для фінішованого стану учасника у порядку CERTIFICATE_LAYOUT."""
+    name = ' '.join(value for value in (state.name, state.surname) if value and value not in hidden_values)
+    duration = format_duration(state.start_time, state.finish_time)
+    return (
+        texts['certificate_title'],
+        texts['certificate_event'],
+        name or texts['anonymous'],
+        texts['certificate_distance'].format(distance=state.distance or 0.0),
+        texts['certificate_time'].format(duration=duration) if duration else None,
+        (state.finish_time or '')[:10],
+    )
+
+
+class CertificateRenderer:
+    """Пул процесів для рендерингу сертифікатів.
+
+    Процеси створюються fork у start(), тож start() має бути першим у процесі бота, до будь-яких потоків
+    (зокрема QueueListener логування) і з'єднань. spawn і forkserver заново виконували б модуль бота
+    в кожному процесі пулу.
+    """
+
+    def __init__(self, template=CERTIFICATE_TEMPLATE, font=CERTIFICATE_FONT, workers=CERTIFICATE_WORKERS):
+        self.template = template
+        self.font = font
+        self.workers = workers
+        self._pool = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._pool is not None
+
+    def start(self):
+        if self.workers <= 0:
+            return self
+        if self.template:
+            # Image.open читає лише заголовок; декодує шаблон уже кожен процес пулу
+            try:
+                with Image.open(self.template):
+                    pass
+            except OSError as e:
+                logger.error(f"Сертифікати вимкнено: не вдалося відкрити шаблон {self.template}: {e}")
+                return self
+        try:
+            ImageFont.truetype(self.font, 10)
+        except OSError:
+            logger.warning(f"Шрифт сертифікатів {self.font} не знайдено, використовується вбудований шрифт Pillow")
+            self.font = None
+        if threading.active_count() > 1:
+            logger.warning("Пул сертифікатів створюється fork при запущених потоках: процес пулу може зависнути "
+                           "на успадкованому замку")
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_load_assets, initargs=(self.template, self.font, os.getpid()))
+        # Пробний рендер запускає процеси одразу і показує помилку шаблону під час старту, а не на першому фініші
+        try:
+            pool.submit(_render, ('',)).result()
+        except Exception as e:
+            logger.error(f"Сертифікати вимкнено: не вдалося підготувати шаблон {self.template}: {e}")
+            pool.shutdown(cancel_futures=True)
+            return self
+        self._pool = pool
+        return self
+
+    def submit(self, lines):
+        """Ставить рендеринг у чергу пулу; повертає concurrent.futures.Future з байтами JPEG."""
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._pool.submit(_render, lines)
+        except BrokenProcessPool as e:
+            # Процес пулу аварійно завершився (наприклад, через брак пам'яті); помилку отримає Future
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def backlog(self):
+        return self._pending
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+class _FileIdCache:
+    """file_id спільних файлів: перше надсилання завантажує файл, решта чатів отримують його за file_id.
+
+    Поки файл завантажується, інші відправники чекають на нього (замок на шлях), а не завантажують ті самі
+    байти паралельно. Підкласи відрізняються лише типом замка і тим, як чекають на бота.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._file_ids = {}
+        self._locks = {}
+
+    def _remember(self, path, message):
+        self._file_ids[path] = message.photo[-1].file_id
+        return message
+
+
+class FileIds(_FileIdCache):
+    def __init__(self, bot):
+        super().__init__(bot)
+        self._lock = threading.Lock()
+
+    def send_photo(self, chat_id, path, **kwargs):
+        file_id = self._file_ids.get(path)
+        if file_id is None:
+            with self._lock:
+                upload_lock = self._locks.setdefault(path, threading.Lock())
+            with upload_lock:
+                file_id = self._file_ids.get(path)
+                if file_id is None:
+                    with open(path, 'rb') as photo:
+                        return self._remember(path, self.bot.send_photo(chat_id, photo, **kwargs))
+        return self.bot.send_photo(chat_id, file_id, **kwargs)
+
+
+class AsyncFileIds(_FileIdCache):
+    """FileIds для AsyncTeleBot."""
+
+    async def send_photo(self, chat_id, path, **kwargs):
+        file_id = self._file_ids.get(path)
+        if file_id is None:
+            async with self._locks.setdefault(path, asyncio.Lock()):
+                file_id = self._file_ids.get(path)
+                if file_id is None:
+                    with open(path, 'rb') as photo:
+                        return self._remember(path, await self.bot.send_photo(chat_id, photo, **kwargs))
+        return await self.bot.send_photo(chat_id, file_id, **kwargs)
@@ -0,0 +1,231 @@
+"""Кроки розмови з учасником, спільні для marathon_bot.py і marathon_bot_async.py.
+
+Обробники кроків нічого не чекають: відповіді ставляться в outbox, результат — у чергу ResultWriter, тож ті
+самі функції виконуються і в потоці ChatOrderedExecutor, і в циклі подій. У кожному боті лишається тільки
+те, що там чекають по-різному: стан сесії, запити до БД і готовий сертифікат.
+"""
+import logging
+from datetime import datetime
+
+import certificates
+import course
+import db
+import geo
+import messages
+import metrics
+import registration
+import tracks
+from leaderboard import runner_label
+from outbox import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+def calculate_distance(start_lat, start_lon, finish_lat, finish_lon):
+    """Рассчитывает расстояние между двумя точками на Земле (в километрах) используя формулу Haversine."""
+    return float(geo.haversine_km(start_lat, start_lon, finish_lat, finish_lon))
+
+
+def attempt_from_session(previous, event_id):
+    """Номер спроби з попередньої сесії: незавершена спроба повторюється, після фінішу — наступна.
+
+    None, якщо сесії тієї самої події немає (наприклад, її видалено за TTL) — тоді номер шукають у БД.
+    """
+    if previous is not None and previous.event_id == event_id and previous.attempt:
+        return previous.attempt + 1 if previous.finish_time else previous.attempt
+    return None
+
+
+def queue_export(outbox, chat_id, result, send_file):
+    """Ставить файли експорту й підсумок у outbox; повертає їхні Future (порожній список, якщо файлів немає)."""
+    if not result.rows:
+        outbox.send_message(chat_id, messages.EXPORT_EMPTY, priority=PRIORITY_BULK)
+        return []
+    futures = [outbox.submit(chat_id, send_file, path, priority=PRIORITY_BULK) for path in result.paths]
+    futures.append(outbox.send_message(chat_id, messages.EXPORT_DONE.format(rows=result.rows, files=len(result.paths)),
+                                       priority=PRIORITY_BULK))
+    return futures
+
+
+class Conversation:
+    """Обробники кроків розмови (state.step) над outbox, ResultWriter, треками, трасою й таблицею лідерів бота.
+
+    when_done(future, callback) викликає callback(future), коли сертифікат з пулу рендерингу готовий, там, де
+    можна звертатися до outbox: у потоці пулу для Outbox, у циклі подій для AsyncOutbox.
+    """
+
+    def __init__(self, outbox, result_writer, live_tracks, leaderboard, event_course, certificate_renderer,
+                 shared_files, when_done):
+        self.outbox = outbox
+        self.result_writer = result_writer
+        self.live_tracks = live_tracks
+        self.leaderboard = leaderboard
+        self.event_course = event_course
+        self.certificate_renderer = certificate_renderer
+        self.shared_files = shared_files
+        self.when_done = when_done
+        # Поточний крок зберігається у state.step замість register_next_step_handler
+        self._handlers = {
+            'language': self.process_language_selection,
+            'start': self.handle_start_location_timeout,
+            'start_retry': self.handle_start_location,
+            'start_outside': self.handle_start_location,
+            'finish': self.handle_finish_location,
+            'finish_outside': self.handle_finish_location,
+        }
+        self._handlers.update((step_name, self.process_field) for step_name in registration.FIELD_STEPS)
+
+    def handler(self, step_name):
+        """Обробник повідомлення на кроці step_name або None, якщо крок повідомлень не чекає."""
+        return self._handlers.get(step_name)
+
+    def enter_step(self, chat_id, state, step_name):
+        """Надсилає підказки кроку з готовою клавіатурою мови учасника і робить крок поточним."""
+        step = registration.STEPS[step_name]
+        texts = messages.TEXTS[state.language]
+        for prompt in step.prompts[:-1]:
+            self.outbox.send_message(chat_id, texts[prompt])
+        prompt = texts[step.prompts[-1]].format(current_year=datetime.now().year)
+        self.outbox.send_message(chat_id, prompt, reply_markup=messages.KEYBOARDS[state.language][step.keyboard])
+        state.step = step_name
+
+    def process_language_selection(self, message, state):
+        language = messages.LANGUAGES.get(message.text)
+        if language is None:
+            self.outbox.send_message(message.chat.id, messages.CHOOSE_LANGUAGE, reply_markup=messages.LANGUAGE_KEYBOARD)
+            return
+        state.language = language
+        self.enter_step(message.chat.id, state, 'name')
+
+    def process_field(self, message, state):
+        """Спільний обробник кроків реєстрації з таблиці registration.STEPS."""
+        chat_id = message.chat.id
+        step = registration.STEPS[state.step]
+        texts = messages.TEXTS[state.language]
+        if message.text in messages.SKIP_TEXTS:
+            value = texts['not_provided']
+        else:
+            value = step.validate(message)
+            if value is None:
+                self.outbox.send_message(chat_id, texts[step.error].format(current_year=datetime.now().year))
+                return
+        setattr(state, step.field, value)
+        registration.complete_field(state, state.step, texts['not_provided'])
+        self.enter_step(chat_id, state, step.next)
+
+    def handle_start_location_timeout(self, message, state):
+        if message.content_type != 'location':
+            if state.start_location is None:
+                self.enter_step(message.chat.id, state, 'start_retry')
+        else:
+            self.handle_start_location(message, state)
+
+    def handle_start_location(self, message, state):
+        location = message.location
+        if location is None:
+            return
+        if self.event_course is not None and not self.event_course.in_start_zone(
+                location.latitude, location.longitude, location.horizontal_accuracy):
+            self.enter_step(message.chat.id, state, 'start_outside')
+            return
+        # Час повідомлення, а не обробки: оновлення, повторене з журналу після збою, дає той самий старт
+        state.start_location = (location.latitude, location.longitude)
+        state.start_time = datetime.fromtimestamp(message.date).strftime(certificates.TIME_FORMAT)
+        self.enter_step(message.chat.id, state, 'finish')
+
+    def start_live_track(self, message, state):
+        chat_id = message.chat.id
+        track = self.live_tracks.start(chat_id, message.location.live_period)
+        if state.start_location:
+            start_timestamp = datetime.strptime(state.start_time, certificates.TIME_FORMAT).timestamp()
+            track.add(*state.start_location, start_timestamp)
+        track.add(message.location.latitude, message.location.longitude, message.date, message.location.horizontal_accuracy)
+        self.outbox.send_message(chat_id, messages.TEXTS[state.language]['live_tracking'])
+
+    def handle_live_location(self, message):
+        # Кожне оновлення трансляції додає одну точку; дистанція рахується лише для нового відрізка
+        track = self.live_tracks.get(message.chat.id)
+        if track is not None and message.location is not None:
+            track.add(message.location.latitude, message.location.longitude, message.edit_date or message.date,
+                      message.location.horizontal_accuracy)
+
+    def check_course(self, chat_id, track, texts):
+        """Звіряє всі точки треку з трасою; про пропущені контрольні точки учасник дізнається одразу."""
+        check = self.event_course.check_track(track.lats, track.lons)
+        if check.off_route_points:
+            logger.info(f"Трек учасника {chat_id}: {check.off_route_points} точок далі ніж "
+                        f"{course.COURSE_ROUTE_TOLERANCE_M:.0f} м від маршруту")
+        if check.missed:
+            names = ', '.join(self.event_course.checkpoints[index].name for index in check.missed)
+            logger.info(f"Учасник {chat_id} пропустив контрольні точки: {names}")
+            self.outbox.send_message(chat_id, texts['missed_checkpoints'].format(missed=names))
+
+    def finish_distance(self, chat_id, state, track, finish_latitude, finish_longitude, finish_timestamp, texts):
+        """Дистанція забігу: за треком трансляції, якщо він є (з перевіркою траси), інакше по прямій від старту."""
+        if track is None:
+            return calculate_distance(*state.start_location, finish_latitude, finish_longitude)
+        track.add(finish_latitude, finish_longitude, finish_timestamp)
+        state.track = tracks.encode(track, tracks.simplify(track))
+        if self.event_course is not None:
+            self.check_course(chat_id, track, texts)
+        return track.distance_km
+
+    def send_certificate(self, chat_id, state, texts):
+        """Ставить сертифікат у пул рендерингу; посилання на сайт надсилається вже після нього."""
+        future = self.certificate_renderer.submit(certificates.certificate_lines(state, texts, messages.NOT_PROVIDED_TEXTS))
+        language = state.language
+
+        def deliver(future):
+            if future.cancelled():
+                # Пул рендерингу зупинено разом із ботом
+                return
+            try:
+                photo = future.result()
+            except Exception as e:
+                logger.error(f"Не вдалося створити сертифікат для {chat_id}: {e}")
+            else:
+                self.outbox.submit(chat_id, 'send_photo', photo, caption=texts['certificate_caption'])
+                if certificates.CERTIFICATE_BADGE:
+                    self.outbox.submit(chat_id, self.shared_files.send_photo, certificates.CERTIFICATE_BADGE)
+            self.outbox.send_message(chat_id, texts['website'], reply_markup=messages.KEYBOARDS[language]['website'])
+
+        self.when_done(future, deliver)
+
+    def handle_finish_location(self, message, state):
+        chat_id = message.chat.id
+        texts = messages.TEXTS[state.language]
+        location = message.location
+        if location is None:
+            logger.debug(f"Немає фінішної геопозиції для {chat_id}")
+            self.outbox.send_message(chat_id, texts['no_location'])
+            return
+        logger.debug(f"Фінішна геопозиція для {chat_id}: {location.latitude}, {location.longitude}")
+        if location.live_period:
+            self.start_live_track(message, state)
+            return
+        if self.event_course is not None and not self.event_course.in_finish_zone(
+                location.latitude, location.longitude, location.horizontal_accuracy):
+            # Трансляція триває, трек лишається в live_tracks до фінішу в зоні
+            self.enter_step(chat_id, state, 'finish_outside')
+            return
+        state.finish_location = (location.latitude, location.longitude)
+        state.finish_time = datetime.fromtimestamp(message.date).strftime(certificates.TIME_FORMAT)
+        track = self.live_tracks.pop(chat_id)
+        if state.start_location:
+            distance = self.finish_distance(chat_id, state, track, location.latitude, location.longitude,
+                                            message.date, texts)
+            logger.info(f"Учасник {chat_id} фінішував: {distance:.3f} км")
+            state.distance = distance
+            if state.event_id is not None and state.event_id == self.leaderboard.event_id:
+                self.leaderboard.record(chat_id, distance,
+                                        runner_label(state.name, state.surname, messages.NOT_PROVIDED_TEXTS))
+            self.outbox.send_message(chat_id, texts['finished'], reply_markup=messages.REMOVE_KEYBOARD)
+            if self.certificate_renderer.enabled:
+                self.send_certificate(chat_id, state, texts)
+            else:
+                self.outbox.send_message(chat_id, texts['website'],
+                                         reply_markup=messages.KEYBOARDS[state.language]['website'])
+        # Запис у PostgreSQL виконується у фоні, обробник не чекає на БД
+        state.step = None
+        metrics.REGISTRATIONS.inc('completed')
+        self.result_writer.submit(db.result_row(state))
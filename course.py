@@ -0,0 +1,269 @@
+"""Геометрія траси офіційної події: стартова і фінішна зони, контрольні точки і маршрут.
+
+Траса задається GeoJSON FeatureCollection (COURSE_PATH), роль об'єкта — у властивості "role":
+    start, finish      Polygon, MultiPolygon або Point з "radius_m" (коло)
+    checkpoint         Point з необов'язковими "radius_m" і "name"
+    route              LineString або MultiLineString
+Координати переводяться в метри локальною рівнокутною проєкцією, як у tracks.simplify, і розкладаються по
+клітинках рівномірної сітки. Запит перевіряє лише об'єкти з клітинок поруч із точкою, тож його вартість не
+залежить від кількості вершин маршруту і контрольних точок, а індекс лише читається і спільний для всіх потоків.
+"""
+import json
+import logging
+import math
+import os
+import time
+from collections import defaultdict, namedtuple
+
+from geo import EARTH_RADIUS_KM
+
+logger = logging.getLogger(__name__)
+
+# Без траси старт і фініш приймаються будь-де, як і раніше
+COURSE_PATH = os.environ.get('COURSE_PATH')
+COURSE_CELL_M = float(os.environ.get('COURSE_CELL_M', 100))
+COURSE_ZONE_RADIUS_M = float(os.environ.get('COURSE_ZONE_RADIUS_M', 50))
+COURSE_CHECKPOINT_RADIUS_M = float(os.environ.get('COURSE_CHECKPOINT_RADIUS_M', 50))
+COURSE_ROUTE_TOLERANCE_M = float(os.environ.get('COURSE_ROUTE_TOLERANCE_M', 100))  # далі — учасник зійшов з маршруту
+COURSE_MAX_ACCURACY_M = float(os.environ.get('COURSE_MAX_ACCURACY_M', 50))  # найбільший допуск на неточність GPS
+
+_M_PER_DEGREE = EARTH_RADIUS_KM * 1000 * math.pi / 180
+
+Checkpoint = namedtuple('Checkpoint', ['name', 'x', 'y', 'radius'])
+# visited і missed — номери контрольних точок у порядку з файлу траси
+TrackCheck = namedtuple('TrackCheck', ['visited', 'missed', 'off_route_points'])
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq)) if length_sq else 0.0
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+class _Grid:
+    """Рівномірна сітка: клітинка -> об'єкти, чиї межі її перетинають."""
+
+    def __init__(self, cell):
+        self.cell = cell
+        self._cells = defaultdict(list)
+
+    def _key(self, x, y):
+        return math.floor(x / self.cell), math.floor(y / self.cell)
+
+    def insert(self, item, xmin, ymin, xmax, ymax):
+        i0, j0 = self._key(xmin, ymin)
+        i1, j1 = self._key(xmax, ymax)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self._cells[(i, j)].append(item)
+
+    def _segment_keys(self, ax, ay, bx, by):
+        # Відрізок ділиться на шматки не довші за клітинку, інакше обмежувальний прямокутник
+        # діагонального відрізка займав би квадрат клітинок
+        pieces = max(1, math.ceil(math.hypot(bx - ax, by - ay) / self.cell))
+        keys = set()
+        for k in range(pieces):
+            x0, y0 = ax + (bx - ax) * k / pieces, ay + (by - ay) * k / pieces
+            x1, y1 = ax + (bx - ax) * (k + 1) / pieces, ay + (by - ay) * (k + 1) / pieces
+            i0, j0 = self._key(min(x0, x1), min(y0, y1))
+            i1, j1 = self._key(max(x0, x1), max(y0, y1))
+            keys.update((i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1))
+        return keys
+
+    def insert_segment(self, item, ax, ay, bx, by):
+        for key in self._segment_keys(ax, ay, bx, by):
+            self._cells[key].append(item)
+
+    def along(self, ax, ay, bx, by):
+        """Об'єкти з клітинок, через які проходить відрізок."""
+        for key in self._segment_keys(ax, ay, bx, by):
+            yield from self._cells.get(key, ())
+
+    def near(self, x, y, radius=0.0):
+        """Об'єкти з клітинок квадрата radius навколо точки, спершу з клітинки самої точки.
+
+        Один об'єкт може трапитися кілька разів.
+        """
+        own = self._key(x, y)
+        yield from self._cells.get(own, ())
+        i0, j0 = self._key(x - radius, y - radius)
+        i1, j1 = self._key(x + radius, y + radius)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                if (i, j) != own:
+                    yield from self._cells.get((i, j), ())
+
+
+class _Zone:
+    """Полігон (кільця в метрах, діри враховуються правилом парності) або коло."""
+
+    def __init__(self, rings=None, center=None, radius=None):
+        self.rings = rings
+        self.center = center
+        self.radius = radius
+
+    def bounds(self):
+        if self.rings is None:
+            (x, y), r = self.center, self.radius
+            return x - r, y - r, x + r, y + r
+        xs = [x for x, _ in self.rings[0]]
+        ys = [y for _, y in self.rings[0]]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def contains(self, x, y, tolerance=0.0):
+        if self.rings is None:
+            return math.hypot(x - self.center[0], y - self.center[1]) <= self.radius + tolerance
+        inside = False
+        for ring in self.rings:
+            for (ax, ay), (bx, by) in zip(ring, ring[1:]):
+                if (ay > y) != (by > y) and x < ax + (y - ay) * (bx - ax) / (by - ay):
+                    inside = not inside
+        if inside or not tolerance:
+            return inside
+        return any(_segment_distance(x, y, ax, ay, bx, by) <= tolerance
+                   for ring in self.rings for (ax, ay), (bx, by) in zip(ring, ring[1:]))
+
+
+class Course:
+    """Траса з просторовим індексом; створюється через load() або from_geojson()."""
+
+    def __init__(self, origin, start_zones, finish_zones, checkpoints, route, cell_m=COURSE_CELL_M):
+        self._lat0, self._lon0 = origin
+        self._kx = _M_PER_DEGREE * math.cos(math.radians(self._lat0))
+        self.start_zones = start_zones
+        self.finish_zones = finish_zones
+        self.checkpoints = checkpoints
+        self.route = route  # лінії маршруту, кожна — список точок у метрах
+
+        self._zones = _Grid(cell_m)
+        for zone in start_zones + finish_zones:
+            self._zones.insert(zone, *zone.bounds())
+        self._checkpoints = _Grid(cell_m)
+        for index, checkpoint in enumerate(checkpoints):
+            x, y, r = checkpoint.x, checkpoint.y, checkpoint.radius
+            self._checkpoints.insert(index, x - r, y - r, x + r, y + r)
+        self._segments = _Grid(cell_m)
+        for line in route:
+            for (ax, ay), (bx, by) in zip(line, line[1:]):
+                self._segments.insert_segment((ax, ay, bx, by), ax, ay, bx, by)
+
+    @classmethod
+    def from_geojson(cls, data, cell_m=COURSE_CELL_M):
+        """Будує трасу з розібраного GeoJSON; ValueError, якщо файл не описує жодного об'єкта траси."""
+        features = data.get('features', []) if data.get('type') == 'FeatureCollection' else [data]
+        points = [point for feature in features for point in _iter_points(feature['geometry'])]
+        if not points:
+            raise ValueError("course GeoJSON has no geometry")
+        origin = (sum(lat for _, lat in points) / len(points), sum(lon for lon, _ in points) / len(points))
+        kx = _M_PER_DEGREE * math.cos(math.radians(origin[0]))
+
+        def project(position):
+            return (position[0] - origin[1]) * kx, (position[1] - origin[0]) * _M_PER_DEGREE
+
+        zones = {'start': [], 'finish': []}
+        checkpoints, route = [], []
+        for feature in features:
+            properties = feature.get('properties') or {}
+            role = properties.get('role')
+            geometry = feature['geometry']
+            kind, coordinates = geometry['type'], geometry['coordinates']
+            if role in zones:
+                if kind == 'Point':
+                    radius = float(properties.get('radius_m', COURSE_ZONE_RADIUS_M))
+                    zones[role].append(_Zone(center=project(coordinates), radius=radius))
+                elif kind in ('Polygon', 'MultiPolygon'):
+                    for polygon in (coordinates if kind == 'MultiPolygon' else [coordinates]):
+                        zones[role].append(_Zone(rings=[[project(p) for p in ring] for ring in polygon]))
+                else:
+                    raise ValueError(f"{role} zone must be a Point or Polygon, got {kind}")
+            elif role == 'checkpoint':
+                if kind != 'Point':
+                    raise ValueError(f"checkpoint must be a Point, got {kind}")
+                name = properties.get('name') or str(len(checkpoints) + 1)
+                radius = float(properties.get('radius_m', COURSE_CHECKPOINT_RADIUS_M))
+                checkpoints.append(Checkpoint(name, *project(coordinates), radius))
+            elif role == 'route':
+                if kind not in ('LineString', 'MultiLineString'):
+                    raise ValueError(f"route must be a LineString, got {kind}")
+                for line in (coordinates if kind == 'MultiLineString' else [coordinates]):
+                    route.append([project(p) for p in line])
+            else:
+                logger.warning(f"Об'єкт траси з невідомою роллю {role!r} пропущено")
+        return cls(origin, zones['start'], zones['finish'], checkpoints, route, cell_m)
+
+    def project(self, lat, lon):
+        return (lon - self._lon0) * self._kx, (lat - self._lat0) * _M_PER_DEGREE
+
+    def _in_zone(self, zones, lat, lon, accuracy):
+        if not zones:
+            return True
+        x, y = self.project(lat, lon)
+        tolerance = min(accuracy or 0.0, COURSE_MAX_ACCURACY_M)
+        return any(zone in zones and zone.contains(x, y, tolerance)
+                   for zone in set(self._zones.near(x, y, tolerance)))
+
+    def in_start_zone(self, lat, lon, accuracy=None):
+        """Чи точка у стартовій зоні з допуском на заявлену точність GPS; без зон — завжди True."""
+        return self._in_zone(self.start_zones, lat, lon, accuracy)
+
+    def in_finish_zone(self, lat, lon, accuracy=None):
+        return self._in_zone(self.finish_zones, lat, lon, accuracy)
+
+    def _on_route(self, x, y):
+        # Для перевірки треку досить першого відрізка в межах допуску, а він майже завжди у клітинці точки
+        return any(_segment_distance(x, y, *segment) <= COURSE_ROUTE_TOLERANCE_M
+                   for segment in self._segments.near(x, y, COURSE_ROUTE_TOLERANCE_M))
+
+    def _checkpoints_along(self, ax, ay, bx, by):
+        """Контрольні точки, чий радіус перетинає відрізок: між рідкими точками трансляції їх легко проскочити."""
+        # Коло, що перетинає відрізок, займає і клітинку точки перетину, тож інших клітинок перевіряти не треба
+        found = set()
+        for index in self._checkpoints.along(ax, ay, bx, by):
+            checkpoint = self.checkpoints[index]
+            if _segment_distance(checkpoint.x, checkpoint.y, ax, ay, bx, by) <= checkpoint.radius:
+                found.add(index)
+        return found
+
+    def check_track(self, lats, lons):
+        """Перевіряє всі точки треку: які контрольні точки пройдено і як далеко трек відходив від маршруту.
+
+        Контрольна точка вважається пройденою, якщо її радіус перетинає хоч один відрізок треку.
+        off_route_points — скільки точок лежить далі за COURSE_ROUTE_TOLERANCE_M від маршруту.
+        """
+        visited = set()
+        off_route = 0
+        previous = None
+        for lat, lon in zip(lats, lons):
+            x, y = self.project(lat, lon)
+            if self.checkpoints:
+                visited |= self._checkpoints_along(*(previous or (x, y)), x, y)
+            if self.route and not self._on_route(x, y):
+                off_route += 1
+            previous = x, y
+        missed = [index for index in range(len(self.checkpoints)) if index not in visited]
+        return TrackCheck(sorted(visited), missed, off_route)
+
+
+def _iter_points(geometry):
+    """Усі позиції [lon, lat] геометрії GeoJSON будь-якої вкладеності."""
+    stack = [geometry['coordinates']]
+    while stack:
+        value = stack.pop()
+        if value and isinstance(value[0], (int, float)):
+            yield value[0], value[1]
+        else:
+            stack.extend(value)
+
+
+def load(path=COURSE_PATH):
+    """Читає трасу з GeoJSON-файлу; None, якщо шлях не задано."""
+    if not path:
+        return None
+    started = time.perf_counter()
+    with open(path, encoding='utf-8') as f:
+        course = Course.from_geojson(json.load(f))
+    logger.info(f"Трасу {path} завантажено за {time.perf_counter() - started:.3f} с: "
+                f"{len(course.start_zones)} стартових і {len(course.finish_zones)} фінішних зон, "
+                f"{len(course.checkpoints)} контрольних точок, {sum(len(line) for line in course.route)} вершин маршруту")
+    return course
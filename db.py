@@ -0,0 +1,290 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))  # seconds
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', 30))  # seconds
+
+# (event_id, chat_id, attempt) — первинний ключ marathon_results, таблиця секціонована за event_id
+KEY_COLUMNS = ('event_id', 'chat_id', 'attempt')
+RESULT_COLUMNS = KEY_COLUMNS + (
+    'name', 'surname', 'birthdate', 'phone_number',
+    'start_time', 'start_latitude', 'start_longitude',
+    'finish_time', 'finish_latitude', 'finish_longitude', 'distance_km',
+    'track_polyline',
+)
+
+UPSERT_STATEMENT = 'upsert_marathon_result'
+# Типи параметрів PostgreSQL виводить із колонок marathon_results
+PREPARE_UPSERT = f"""
+    PREPARE {UPSERT_STATEMENT} AS
+    INSERT INTO marathon_results ({', '.join(RESULT_COLUMNS)})
+    VALUES ({', '.join(f'${i}' for i in range(1, len(RESULT_COLUMNS) + 1))})
+    ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in RESULT_COLUMNS[len(KEY_COLUMNS):])},
+        updated_at = now();
+"""
+EXECUTE_UPSERT = f"EXECUTE {UPSERT_STATEMENT} ({', '.join(['%s'] * len(RESULT_COLUMNS))});"
+BULK_UPSERT = f"""
+    INSERT INTO marathon_results ({', '.join(RESULT_COLUMNS)})
+    VALUES %s
+    ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in RESULT_COLUMNS[len(KEY_COLUMNS):])},
+        updated_at = now();
+"""
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Усі з'єднання пулу зайняті довше, ніж DB_POOL_TIMEOUT."""
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'prepared', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """Обмежений потокобезпечний пул з'єднань PostgreSQL з перевіркою стану та перепідключенням."""
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, healthcheck_interval=DB_HEALTHCHECK_INTERVAL):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        # Одиночний upsert атомарний сам по собі, окремий COMMIT був би зайвим round trip
+        conn.autocommit = True
+        return _PooledConnection(conn)
+
+    def _is_alive(self, pooled):
+        if pooled.conn.closed:
+            return False
+        if time.monotonic() - pooled.last_used < self.healthcheck_interval:
+            return True
+        try:
+            with pooled.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(pooled):
+        try:
+            pooled.conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _discard(self, pooled):
+        self._close_quietly(pooled)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    pooled = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"no free database connection after {self.timeout}s")
+                self._cond.wait(remaining)
+
+        if pooled is not None:
+            if self._is_alive(pooled):
+                return pooled
+            # Слот у пулі лишається за нами, замінюємо лише саме з'єднання
+            logger.warning("Discarding broken PostgreSQL connection")
+            self._close_quietly(pooled)
+        try:
+            return self._connect()
+        except psycopg2.Error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, pooled):
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(pooled)
+                self._cond.notify()
+                return
+        self._discard(pooled)
+
+    @contextmanager
+    def connection(self):
+        """Видає з'єднання з пулу; при збої з'єднання воно не повертається до пулу."""
+        with metrics.DB_POOL_WAIT_SECONDS.time():
+            pooled = self._acquire()
+        try:
+            yield pooled
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(pooled)
+            raise
+        except Exception:
+            if not pooled.conn.closed:
+                pooled.conn.rollback()
+            self._release(pooled)
+            raise
+        else:
+            self._release(pooled)
+
+    def warm_up(self):
+        """Відкриває minconn з'єднань заздалегідь, щоб перший фініш не чекав на handshake."""
+        opened = []
+        try:
+            for _ in range(self.minconn):
+                opened.append(self._acquire())
+        finally:
+            for pooled in opened:
+                self._release(pooled)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+
+VALIDATION_COLUMNS = KEY_COLUMNS + (
+    'distance_km', 'avg_speed_kmh', 'pace_min_per_km', 'max_track_speed_kmh', 'flags',
+)
+SAVE_VALIDATIONS = f"""
+    INSERT INTO result_validations ({', '.join(VALIDATION_COLUMNS)})
+    VALUES %s
+    ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in VALIDATION_COLUMNS[len(KEY_COLUMNS):])},
+        validated_at = now();
+"""
+
+
+def prepare(pooled, name, statement):
+    """Готує серверний prepared statement один раз на з'єднання."""
+    if name not in pooled.prepared:
+        with pooled.conn.cursor() as cur:
+            cur.execute(statement)
+        pooled.prepared.add(name)
+
+
+def run_with_retry(pool, func, retries=1, operation=None):
+    """Виконує func(pooled) і повторює спробу на новому з'єднанні, якщо старе обірвалося.
+
+    Тривалість пишеться у metrics.DB_SECONDS з міткою operation (типово func.__name__).
+    """
+    with metrics.DB_SECONDS.time(operation or func.__name__):
+        for attempt in range(retries + 1):
+            try:
+                with pool.connection() as pooled:
+                    return func(pooled)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if attempt >= retries or isinstance(e, PoolTimeout):
+                    raise
+                logger.warning(f"Повторна спроба запиту до PostgreSQL після збою з'єднання: {e}")
+
+
+def run_queries(pool, plan, *args):
+    """Виконує план запитів plan(*args) на одному з'єднанні через run_with_retry; повертає результат плану.
+
+    План — генератор, що віддає (query, params) і отримує курсор із результатом запиту. Той самий план
+    виконує aiodb.run_queries, тож запити, спільні для обох ботів, пишуться один раз. Мітка — plan.__name__.
+    """
+    def run(pooled):
+        steps = plan(*args)
+        with pooled.conn.cursor() as cur:
+            try:
+                query, params = next(steps)
+                while True:
+                    cur.execute(query, params)
+                    query, params = steps.send(cur)
+            except StopIteration as stop:
+                return stop.value
+
+    return run_with_retry(pool, run, operation=plan.__name__)
+
+
+def result_row(state):
+    """Формує рядок для marathon_results зі стану учасника у порядку RESULT_COLUMNS."""
+    start_location = state.start_location or (None, None)
+    finish_location = state.finish_location or (None, None)
+    return (
+        state.event_id,
+        state.chat_id,
+        # None, якщо номер спроби не вдалося визначити на старті; його підставить ResultWriter
+        state.attempt,
+        state.name or '',
+        state.surname or '',
+        state.birthdate or '',
+        state.phone_number or '',
+        state.start_time,
+        start_location[0],
+        start_location[1],
+        state.finish_time,
+        finish_location[0],
+        finish_location[1],
+        state.distance,
+        state.track,
+    )
+
+
+def save_result(pool, row):
+    """Записує результат забігу одним round trip через підготовлений upsert."""
+    def upsert(pooled):
+        prepare(pooled, UPSERT_STATEMENT, PREPARE_UPSERT)
+        with pooled.conn.cursor() as cur:
+            cur.execute(EXECUTE_UPSERT, row)
+
+    run_with_retry(pool, upsert)
+
+
+def save_results(pool, rows):
+    """Записує пачку результатів одним багаторядковим upsert.
+
+    У пачці не має бути двох рядків з однаковим ключем (event_id, chat_id, attempt), інакше
+    ON CONFLICT відмовить; ResultWriter залишає лише останній рядок для кожної спроби.
+    """
+    if len(rows) == 1:
+        save_result(pool, rows[0])
+        return
+
+    def bulk_upsert(pooled):
+        with pooled.conn.cursor() as cur:
+            execute_values(cur, BULK_UPSERT, rows, page_size=len(rows))
+
+    run_with_retry(pool, bulk_upsert)
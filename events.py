@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+
+import aiodb
+import db
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Без EVENT_SLUG поточною вважається подія, що вже почалася найпізніше (або найближча майбутня)
+EVENT_SLUG = os.environ.get('EVENT_SLUG')
+EVENT_REFRESH = float(os.environ.get('EVENT_REFRESH', 60))  # seconds
+DEFAULT_EVENT_TITLE = "Марафон Героїв"
+
+EVENT_BY_SLUG_QUERY = "SELECT id FROM events WHERE slug = %s"
+CURRENT_EVENT_QUERY = """
+    SELECT id FROM events
+    ORDER BY starts_on <= current_date DESC, abs(starts_on - current_date), id DESC
+    LIMIT 1
+"""
+UPSERT_EVENT = """
+    INSERT INTO events (slug, title, starts_on, ends_on) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (slug) DO UPDATE SET
+        title = EXCLUDED.title, starts_on = EXCLUDED.starts_on, ends_on = EXCLUDED.ends_on
+    RETURNING id
+"""
+NEXT_ATTEMPT_QUERY = """
+    SELECT coalesce(max(attempt), 0) + 1 FROM marathon_results WHERE event_id = %s AND chat_id = %s
+"""
+# Для рядка без номера спроби: спроба вже записаного того самого забігу (за start_time) і остання спроба учасника
+RESOLVE_ATTEMPT_QUERY = """
+    SELECT
+        (SELECT min(attempt) FROM marathon_results
+         WHERE event_id = %(event_id)s AND chat_id = %(chat_id)s AND start_time = %(start_time)s),
+        (SELECT coalesce(max(attempt), 0) FROM marathon_results WHERE event_id = %(event_id)s AND chat_id = %(chat_id)s)
+"""
+_START_TIME = db.RESULT_COLUMNS.index('start_time')
+
+
+def upsert_event(slug, title, starts_on, ends_on):
+    """План запитів: створює подію (або оновлює назву й дати існуючої) разом із її секцією; повертає id."""
+    cur = yield UPSERT_EVENT, (slug, title, starts_on, ends_on)
+    event_id = cur.fetchone()[0]
+    yield migrations.partition_ddl(event_id), None
+    return event_id
+
+
+def event_by_slug(slug):
+    cur = yield EVENT_BY_SLUG_QUERY, (slug,)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def events_with_counts():
+    cur = yield """
+        SELECT e.id, e.slug, e.title, e.starts_on, e.ends_on, count(r.chat_id)
+        FROM events e LEFT JOIN marathon_results r ON r.event_id = e.id
+        GROUP BY e.id ORDER BY e.starts_on, e.id
+    """, None
+    return cur.fetchall()
+
+
+def attempt_lookup(event_id, chat_id):
+    cur = yield NEXT_ATTEMPT_QUERY, (event_id, chat_id)
+    return cur.fetchone()[0]
+
+
+def current_event_lookup(slug, partitions):
+    """План запитів CurrentEvent: id події за slug або поточної; якщо подій немає, створює подію на сьогодні."""
+    cur = yield (EVENT_BY_SLUG_QUERY, (slug,)) if slug else (CURRENT_EVENT_QUERY, None)
+    row = cur.fetchone()
+    if row is None:
+        today = datetime.date.today()
+        slug = slug or f"marathon-{today.isoformat()}"
+        logger.warning(f"Подій немає, створюю {slug}")
+        event_id = yield from upsert_event(slug, DEFAULT_EVENT_TITLE, today, today)
+    else:
+        event_id = row[0]
+        if event_id not in partitions:
+            # Подію могли додати напряму в SQL, без секції
+            yield migrations.partition_ddl(event_id), None
+    partitions.add(event_id)
+    return event_id
+
+
+def create_event(pool, slug, title, starts_on, ends_on):
+    """Створює подію (або оновлює назву й дати існуючої) разом із її секцією; повертає id."""
+    return db.run_queries(pool, upsert_event, slug, title, starts_on, ends_on)
+
+
+def find_event(pool, slug):
+    """id події за slug або None."""
+    return db.run_queries(pool, event_by_slug, slug)
+
+
+def list_events(pool):
+    return db.run_queries(pool, events_with_counts)
+
+
+def next_attempt(pool, event_id, chat_id):
+    """Номер наступної спроби учасника в події; пошук за первинним ключем у секції події."""
+    return db.run_queries(pool, attempt_lookup, event_id, chat_id)
+
+
+async def next_attempt_async(pool, event_id, chat_id):
+    """next_attempt для асинхронного пулу aiodb."""
+    return await aiodb.run_queries(pool, attempt_lookup, event_id, chat_id)
+
+
+def _runs_without_attempt(rows):
+    """Забіги (event_id, chat_id, start_time) з рядків без номера спроби, без повторів."""
+    return list(dict.fromkeys((row[0], row[1], row[_START_TIME]) for row in rows if row[2] is None))
+
+
+def _with_attempts(rows, runs, found):
+    # Забіг, уже записаний раніше, зберігає свою спробу: повторний запис зі спулу чи журналу не створить
+    # нової. Новий забіг отримує наступну після останньої в БД і в самій пачці
+    taken = {}
+    for row in rows:
+        if row[2] is not None:
+            taken[row[:2]] = max(taken.get(row[:2], 0), row[2])
+    attempts = {}
+    for run, (existing, latest) in zip(runs, found):
+        if existing is None:
+            existing = taken[run[:2]] = max(latest, taken.get(run[:2], 0)) + 1
+        attempts[run] = existing
+    return [row[:2] + (attempts[(row[0], row[1], row[_START_TIME])],) + row[3:] if row[2] is None else row
+            for row in rows]
+
+
+def attempts_lookup(rows):
+    """План запитів resolve_attempts: спроба кожного забігу без номера за start_time, інакше наступна."""
+    runs = _runs_without_attempt(rows)
+    found = []
+    for event_id, chat_id, start_time in runs:
+        cur = yield RESOLVE_ATTEMPT_QUERY, {'event_id': event_id, 'chat_id': chat_id, 'start_time': start_time}
+        found.append(cur.fetchone())
+    return _with_attempts(rows, runs, found)
+
+
+def resolve_attempts(pool, rows):
+    """Підставляє номер спроби в рядки результатів, записані без нього, поки БД чи подія були недоступні.
+
+    Рядки мають містити event_id; рядки з відомою спробою не змінюються.
+    """
+    if all(row[2] is not None for row in rows):
+        return rows
+    return db.run_queries(pool, attempts_lookup, rows)
+
+
+async def resolve_attempts_async(pool, rows):
+    """resolve_attempts для асинхронного пулу aiodb."""
+    if all(row[2] is not None for row in rows):
+        return rows
+    return await aiodb.run_queries(pool, attempts_lookup, rows)
+
+
+class _EventCache:
+    """Останній id поточної події і час перевірки; спільне для CurrentEvent і AsyncCurrentEvent."""
+
+    def __init__(self, pool, slug, refresh):
+        self.pool = pool
+        self.slug = slug
+        self.refresh = refresh
+        self._event_id = None
+        self._checked_at = None
+        self._partitions = set()
+
+    def _fresh(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.refresh
+
+    def _store(self, event_id=None, error=None):
+        if error is not None:
+            logger.error(f"Не вдалося визначити поточну подію: {error}")
+        else:
+            if event_id != self._event_id:
+                logger.info(f"Поточна подія: {event_id}")
+            self._event_id = event_id
+        # Після збою теж чекаємо refresh, щоб не звертатися до недоступної БД на кожне оновлення
+        self._checked_at = time.monotonic()
+        return self._event_id
+
+
+class CurrentEvent(_EventCache):
+    """id поточної події з періодичним оновленням, щоб новий марафон підхоплювався без перезапуску."""
+
+    def __init__(self, pool, slug=EVENT_SLUG, refresh=EVENT_REFRESH):
+        super().__init__(pool, slug, refresh)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """id поточної події або None, якщо БД недоступна і подія ще не відома."""
+        if self._fresh():
+            return self._event_id
+        with self._lock:
+            if self._fresh():
+                return self._event_id
+            try:
+                event_id = db.run_queries(self.pool, current_event_lookup, self.slug, self._partitions)
+            except psycopg2.Error as e:
+                return self._store(error=e)
+            return self._store(event_id)
+
+
+class AsyncCurrentEvent(_EventCache):
+    """CurrentEvent для асинхронного бота: ті самі запити через aiodb."""
+
+    def __init__(self, pool, slug=EVENT_SLUG, refresh=EVENT_REFRESH):
+        super().__init__(pool, slug, refresh)
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        """id поточної події або None; поки триває оновлення, інші корутини чекають його, а не дублюють запит."""
+        if self._fresh():
+            return self._event_id
+        async with self._lock:
+            if self._fresh():
+                return self._event_id
+            try:
+                event_id = await aiodb.run_queries(self.pool, current_event_lookup, self.slug, self._partitions)
+            except psycopg2.Error as e:
+                return self._store(error=e)
+            return self._store(event_id)
@@ -0,0 +1,193 @@
+import gzip
+import logging
+import os
+from collections import namedtuple
+from datetime import date, timedelta
+
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+import db
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = db.RESULT_COLUMNS + ('updated_at',)
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 100000))
+COPY_BUFFER_SIZE = 1024 * 1024  # bytes
+GZIP_LEVEL = 6  # помітно швидше за типовий 9 при майже тому самому розмірі
+# updated_at = now() — час початку транзакції запису, а не коміту: upsert, що почався до знімка експорту,
+# а закомітився після, має updated_at раніше за курсор. Курсор зберігається з цим запасом, тож такі рядки
+# потрапляють у наступний експорт; рядки із запасу вивантажуються двічі, дублікати — з тими самими
+# (event_id, chat_id, attempt, updated_at)
+EXPORT_CURSOR_LAG = timedelta(seconds=float(os.environ.get('EXPORT_CURSOR_LAG', 60)))
+
+ExportResult = namedtuple('ExportResult', ['paths', 'rows', 'exported_until'])
+
+LOAD_CURSOR = "SELECT exported_until FROM export_cursors WHERE name = %s"
+SAVE_CURSOR = """
+    INSERT INTO export_cursors (name, exported_until) VALUES (%s, %s)
+    ON CONFLICT (name) DO UPDATE SET exported_until = EXCLUDED.exported_until
+"""
+
+
+class ChunkedFiles:
+    """Файлоподібний приймач для copy_expert: ділить потік рядків на файли по chunk_rows рядків.
+
+    Дані ніколи не накопичуються в пам'яті — кожен блок COPY одразу пишеться у поточний файл.
+    Заголовок CSV повторюється на початку кожного файлу.
+    """
+
+    def __init__(self, directory, prefix, extension, chunk_rows=None, compress=False, header=False):
+        self.directory = directory
+        self.prefix = prefix
+        self.extension = extension + ('.gz' if compress else '')
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.paths = []
+        self.rows = 0
+        self._header = None
+        self._pending_header = b'' if header else None
+        self._file = None
+        self._chunk_lines = 0
+
+    def _open(self):
+        if self.chunk_rows:
+            name = f"{self.prefix}-{len(self.paths) + 1:04d}.{self.extension}"
+        else:
+            name = f"{self.prefix}.{self.extension}"
+        path = os.path.join(self.directory, name)
+        self._file = gzip.open(path, 'wb', compresslevel=GZIP_LEVEL) if self.compress else open(path, 'wb')
+        self.paths.append(path)
+        self._chunk_lines = 0
+        if self._header:
+            self._file.write(self._header)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self._pending_header is not None:
+            end = data.find(b'\n')
+            if end < 0:
+                self._pending_header += data
+                return
+            self._header = self._pending_header + data[:end + 1]
+            self._pending_header = None
+            data = data[end + 1:]
+            self._open()
+        while data:
+            if self._file is None:
+                self._open()
+            lines = data.count(b'\n')
+            remaining = self.chunk_rows - self._chunk_lines if self.chunk_rows else lines + 1
+            if lines < remaining:
+                self._file.write(data)
+                self._chunk_lines += lines
+                self.rows += lines
+                return
+            end = -1
+            for _ in range(remaining):
+                end = data.index(b'\n', end + 1)
+            self._file.write(data[:end + 1])
+            self.rows += remaining
+            self._close_file()
+            data = data[end + 1:]
+
+    def close(self):
+        self._close_file()
+
+
+def parse_command_args(args):
+    """Аргументи команди /export у параметри export_results; ValueError для незрозумілих."""
+    options = {'fmt': 'csv', 'cursor_name': 'bot'}
+    for arg in args:
+        if arg in EXPORT_FORMATS:
+            options['fmt'] = arg
+        elif arg == 'all':
+            options['cursor_name'] = None
+        else:
+            first, _, last = arg.partition('..')
+            options['date_from'] = date.fromisoformat(first)
+            options['date_to'] = date.fromisoformat(last or first)
+            options['cursor_name'] = None
+    return options
+
+
+def build_query(cur, fmt='csv', event_id=None, date_from=None, date_to=None, since=None, until=None):
+    """Запит COPY з підставленими фільтрами; COPY не приймає параметрів, тож значення екранує mogrify."""
+    conditions, params = [], []
+    event_date = "start_time::date"
+    if event_id is not None:
+        # Умова за ключем секціонування: COPY читає лише секцію події
+        conditions.append("event_id = %s")
+        params.append(event_id)
+    if date_from is not None:
+        conditions.append(f"{event_date} >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append(f"{event_date} <= %s")
+        params.append(date_to)
+    if since is not None:
+        conditions.append("updated_at > %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("updated_at <= %s")
+        params.append(until)
+    select = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM marathon_results"
+    if conditions:
+        select += " WHERE " + " AND ".join(conditions)
+    select = cur.mogrify(select, params).decode()
+    if fmt == 'jsonl':
+        # Роздільник і лапки CSV, яких не буває в JSON (row_to_json екранує керівні символи),
+        # дають рядки JSON без екранування зворотних слешів, як у текстовому форматі COPY
+        return (f"COPY (SELECT row_to_json(r) FROM ({select}) r) TO STDOUT "
+                "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+    return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+
+def export_results(conn, directory, fmt='csv', compress=False, chunk_rows=None, event_id=None,
+                   date_from=None, date_to=None, cursor_name=None, prefix='marathon_results'):
+    """Вивантажує marathon_results через COPY ... TO STDOUT у файли в directory.
+
+    Якщо задано cursor_name, вивантажуються лише рядки, змінені після попереднього експорту з тим самим
+    курсором, а курсор зсувається після успішного запису файлів до exported_until мінус EXPORT_CURSOR_LAG.
+    З event_id курсор свій у кожної події: експорт однієї події не зсуває його для іншої.
+    Рядки за останні EXPORT_CURSOR_LAG наступний експорт вивантажить повторно; отримувач відкидає дублікати
+    за ключем і updated_at. Повертає ExportResult.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unsupported export format {fmt!r}")
+    if cursor_name is not None and event_id is not None:
+        cursor_name = f"{cursor_name}:event-{event_id}"
+    os.makedirs(directory, exist_ok=True)
+    sink = ChunkedFiles(directory, prefix, fmt, chunk_rows, compress, header=fmt == 'csv')
+    # Один знімок на весь експорт: рядки, закомічені під час COPY, не потраплять у файли частково.
+    # Закомічені після знімка, але з updated_at до localtimestamp, покриває запас EXPORT_CURSOR_LAG
+    conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, autocommit=False)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT localtimestamp")
+            until = cur.fetchone()[0]
+            since = None
+            if cursor_name is not None:
+                cur.execute(LOAD_CURSOR, (cursor_name,))
+                row = cur.fetchone()
+                since = row[0] if row else None
+            query = build_query(cur, fmt, event_id, date_from, date_to, since, until if cursor_name else None)
+            try:
+                cur.copy_expert(query, sink, size=COPY_BUFFER_SIZE)
+            finally:
+                sink.close()
+            if cursor_name is not None:
+                cursor = until - EXPORT_CURSOR_LAG
+                cur.execute(SAVE_CURSOR, (cursor_name, cursor if since is None else max(since, cursor)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(f"Експортовано {sink.rows} результатів у {len(sink.paths)} файл(ів) у {directory}")
+    return ExportResult(sink.paths, sink.rows, until)
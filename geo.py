@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+MIN_DISTANCE_KM = float(os.environ.get('MIN_DISTANCE_KM', 0.05))
+MAX_AVG_SPEED_KMH = float(os.environ.get('MAX_AVG_SPEED_KMH', 25))  # швидше за світовий рекорд на довгих дистанціях
+TELEPORT_SPEED_KMH = float(os.environ.get('TELEPORT_SPEED_KMH', 60))  # стрибок GPS між сусідніми точками треку
+
+# Прапорці вердикту перевірки, поєднуються побітово
+FLAG_ZERO_DISTANCE = 1
+FLAG_IMPOSSIBLE_SPEED = 2
+FLAG_TELEPORT = 4
+FLAG_BAD_TIME = 8
+# Перевірки траси офіційної події (course.py)
+FLAG_OUTSIDE_ZONE = 16
+FLAG_MISSED_CHECKPOINT = 32
+FLAG_OFF_ROUTE = 64
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Відстань за формулою Haversine (км) для скалярів або масивів NumPy з broadcast."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def validate_runs(start_lat, start_lon, finish_lat, finish_lon, duration_s, track_distance_km=None):
+    """Перевіряє пачку забігів за один прохід.
+
+    Повертає (distance_km, avg_speed_kmh, pace_min_per_km, flags). Якщо для забігу є трек,
+    у track_distance_km передається його довжина, інакше NaN — тоді береться пряма старт—фініш.
+    """
+    distance = haversine_km(start_lat, start_lon, finish_lat, finish_lon)
+    if track_distance_km is not None:
+        track_distance_km = np.asarray(track_distance_km, dtype=np.float64)
+        distance = np.where(np.isnan(track_distance_km), distance, track_distance_km)
+    duration_s = np.asarray(duration_s, dtype=np.float64)
+    bad_time = ~(duration_s > 0)  # NaN теж сюди
+    hours = np.where(bad_time, np.nan, duration_s / 3600)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = distance / hours
+        pace = np.where(distance > 0, hours * 60 / distance, np.nan)
+
+    flags = np.zeros(distance.shape, dtype=np.int32)
+    flags |= np.where(~(distance >= MIN_DISTANCE_KM), FLAG_ZERO_DISTANCE, 0).astype(np.int32)
+    flags |= np.where(speed > MAX_AVG_SPEED_KMH, FLAG_IMPOSSIBLE_SPEED, 0).astype(np.int32)
+    flags |= np.where(bad_time, FLAG_BAD_TIME, 0).astype(np.int32)
+    return distance, speed, pace, flags
+
+
+def validate_tracks(lats, lons, times, offsets):
+    """Перевіряє всі точки кількох треків, складених в один масив.
+
+    offsets — індекси початку кожного треку в lats/lons/times (як у np.add.reduceat).
+    Повертає (distance_km, max_speed_kmh, flags) для кожного треку.
+    """
+    lats, lons, times = (np.asarray(v, dtype=np.float64) for v in (lats, lons, times))
+    offsets = np.asarray(offsets, dtype=np.intp)
+    n_tracks = len(offsets)
+    if n_tracks == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int32)
+
+    # Відрізок i з'єднує точки i та i+1; відрізки на межі двох треків відкидаються
+    segment = haversine_km(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    dt = np.diff(times)
+    boundary = np.zeros(len(segment), dtype=bool)
+    boundary[offsets[1:] - 1] = True
+    segment[boundary] = 0.0
+    # Час у Telegram з точністю до секунди: дві точки тієї самої секунди (старт і перша точка трансляції)
+    # рахуються як рознесені на секунду, а не як нескінченна швидкість
+    speed = segment / np.maximum(dt, 1.0) * 3600
+    speed[boundary] = 0.0
+
+    # Треки з однієї точки не мають відрізків
+    lengths = np.diff(np.append(offsets, len(lats)))
+    segment_offsets = np.minimum(offsets, max(len(segment) - 1, 0))
+    distance = np.zeros(n_tracks)
+    max_speed = np.zeros(n_tracks)
+    if len(segment):
+        has_segments = lengths > 1
+        distance[has_segments] = np.add.reduceat(segment, segment_offsets)[has_segments]
+        max_speed[has_segments] = np.maximum.reduceat(speed, segment_offsets)[has_segments]
+
+    flags = np.where(max_speed > TELEPORT_SPEED_KMH, FLAG_TELEPORT, 0).astype(np.int32)
+    return distance, max_speed, flags
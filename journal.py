@@ -0,0 +1,307 @@
+"""Журнал оновлень і станів учасників для перезапуску без втрат під час забігу.
+
+Отримане оновлення записується в журнал (fsync) до того, як Telegram отримає підтвердження через offset
+getUpdates або відповідь webhook. Після обробки в журнал дописується стан учасника. Під час запуску журнал
+читається: стани повертаються у сховище сесій, оновлення без позначки обробки обробляються повторно, а id
+нещодавніх оновлень відсіюють повторну доставку. Після читання і коли файл виростає до JOURNAL_COMPACT_BYTES,
+журнал переписується знімком.
+
+Журнал належить одному процесу: open() бере блокування файлу і відмовляє, якщо ним уже користується інший
+процес, — кожному воркеру потрібен свій JOURNAL_PATH.
+
+Формат — рядки JSON, які лише дописуються:
+    {"o": offset}                                    наступний offset для getUpdates
+    {"i": update_id, "update": {...}}                отримане оновлення
+    {"u": update_id, "s": [[chat_id, state, expires_at], ...]}   оновлення оброблено і стани після нього
+    {"s": [[chat_id, state, expires_at], ...]}       стани поза обробкою оновлення та у знімку
+    {"r": [update_id, ...]}                          нещодавно отримані id у знімку
+Обрізаний останній рядок (збій посеред запису) ігнорується.
+"""
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from session_store import RunnerState
+
+logger = logging.getLogger(__name__)
+
+# Порожній JOURNAL_PATH вимикає журнал; відсіювання повторних оновлень у межах процесу лишається
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', 'marathon_journal.jsonl')
+JOURNAL_SYNC_INTERVAL = float(os.environ.get('JOURNAL_SYNC_INTERVAL', 0.2))  # seconds
+JOURNAL_COMPACT_BYTES = int(os.environ.get('JOURNAL_COMPACT_BYTES', 16 * 1024 * 1024))
+JOURNAL_RECENT_UPDATES = 10000
+
+# update_id оновлення, яке зараз обробляється; JournaledStore прив'язує до нього збережений стан
+current_update = contextvars.ContextVar('current_update', default=None)
+
+
+class JournalLocked(Exception):
+    """Журналом уже користується інший процес."""
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+class Journal:
+    """Журнал з груповим fsync: записи накопичуються в пам'яті й потрапляють на диск за sync()."""
+
+    def __init__(self, path=JOURNAL_PATH, sync_interval=JOURNAL_SYNC_INTERVAL, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_bytes = compact_bytes
+        self.offset = None
+        self._states = {}       # chat_id -> (state, expires_at)
+        self._pending = {}      # update_id -> оновлення, отримане, але ще не оброблене
+        self._recent = {}       # нещодавно отримані update_id у порядку надходження
+        self._staged = {}       # update_id -> стани, збережені під час його обробки
+        self._finished = []     # стани з фінішем, записані після останнього знімка
+        self._buffer = []
+        self._file = None
+        self._lock_file = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+
+    def open(self):
+        """Читає журнал, переписує його знімком і запускає фоновий fsync.
+
+        JournalLocked, якщо той самий журнал відкрив інший процес: інакше він обробив би чужі необроблені
+        оновлення, а стиснення замінило б файл, у який той процес досі пише.
+        """
+        if self.path:
+            self._acquire()
+            started = time.perf_counter()
+            self._replay()
+            self._compact()
+            logger.info(f"Журнал {self.path} прочитано за {time.perf_counter() - started:.3f} с: "
+                        f"{len(self._states)} станів, {len(self._pending)} необроблених оновлень")
+        self._thread.start()
+        return self
+
+    def _acquire(self):
+        # Окремий файл блокування: сам журнал стиснення замінює новим файлом
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise JournalLocked(f"Журнал {self.path} уже відкрито іншим процесом; задайте окремий JOURNAL_PATH") from None
+        self._lock_file = lock_file
+
+    def _replay(self):
+        try:
+            f = open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Пропущено пошкоджений рядок {number} журналу {self.path}")
+                    continue
+                if 'o' in record:
+                    self.offset = record['o']
+                if 'r' in record:
+                    self._recent.update(dict.fromkeys(record['r']))
+                if 'i' in record:
+                    self._pending[record['i']] = record['update']
+                    self._recent[record['i']] = None
+                if 'u' in record:
+                    self._pending.pop(record['u'], None)
+                for chat_id, payload, expires_at in record.get('s', ()):
+                    self._states[chat_id] = (payload, expires_at)
+                    if 'u' in record:
+                        self._finished.append(payload)
+        self._finished = [payload for payload in self._finished if RunnerState.loads(payload).finish_time]
+
+    def states(self):
+        """Непрострочені стани з журналу."""
+        now = time.time()
+        return [RunnerState.loads(payload) for payload, expires_at in self._states.values() if expires_at >= now]
+
+    def finished_since_snapshot(self):
+        """Фініші з хвоста журналу до запуску: їх результати могли не дійти до БД до збою. Повертає їх один раз."""
+        finished, self._finished = self._finished, []
+        return [RunnerState.loads(payload) for payload in finished]
+
+    def pending(self):
+        """Оновлення, отримані до збою, але не оброблені, у порядку надходження."""
+        return list(self._pending.values())
+
+    def received(self, updates, offset=None):
+        """Додає отримані оновлення (JSON-словники) і новий offset; на диск вони потрапляють за sync().
+
+        Повертає оновлення, яких ще не було: повторна доставка того самого update_id відкидається.
+        """
+        fresh = []
+        with self._lock:
+            for update in updates:
+                if update['update_id'] in self._recent:
+                    continue
+                fresh.append(update)
+                self._pending[update['update_id']] = update
+                self._recent[update['update_id']] = None
+                self._buffer.append(_line({'i': update['update_id'], 'update': update}))
+            while len(self._recent) > JOURNAL_RECENT_UPDATES:
+                del self._recent[next(iter(self._recent))]
+            if offset is not None:
+                self.offset = offset
+                self._buffer.append(_line({'o': offset}))
+        return fresh
+
+    def record_state(self, state):
+        entry = [state.chat_id, state.dumps(), time.time() + state.ttl()]
+        update_id = current_update.get()
+        with self._lock:
+            if update_id is not None and update_id in self._pending:
+                self._staged.setdefault(update_id, []).append(entry)
+            else:
+                self._states[state.chat_id] = (entry[1], entry[2])
+                self._buffer.append(_line({'s': [entry]}))
+
+    def done(self, update_id):
+        """Позначає оновлення обробленим разом зі станами, збереженими під час обробки, одним рядком."""
+        with self._lock:
+            self._pending.pop(update_id, None)
+            entries = self._staged.pop(update_id, [])
+            for chat_id, payload, expires_at in entries:
+                self._states[chat_id] = (payload, expires_at)
+            self._buffer.append(_line({'u': update_id, 's': entries} if entries else {'u': update_id}))
+
+    def sync(self):
+        """Записує накопичені записи і чекає fsync; одночасні виклики об'єднуються в один запис."""
+        if not self.path:
+            with self._lock:
+                self._buffer.clear()
+            return
+        with self._sync_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+            if not lines:
+                return
+            data = ''.join(lines).encode()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._size += len(data)
+            if self._size >= self.compact_bytes:
+                self._compact()
+
+    def try_sync(self):
+        """sync(), що не піднімає OSError, а пише його в лог; повертає True, якщо записи на диску.
+
+        Оновлення, отримане до збою запису, все одно треба обробити: received() уже запам'ятав його id
+        і відкине повторну доставку.
+        """
+        try:
+            self.sync()
+            return True
+        except OSError as e:
+            logger.error(f"Не вдалося записати журнал {self.path}: {e}")
+            return False
+
+    def _compact(self):
+        """Переписує журнал знімком: offset, живі стани, нещодавні id і необроблені оновлення."""
+        tmp_path = self.path + '.tmp'
+        now = time.time()
+        with self._lock:
+            self._states = {chat_id: entry for chat_id, entry in self._states.items() if entry[1] >= now}
+            lines = []
+            if self.offset is not None:
+                lines.append(_line({'o': self.offset}))
+            states = [[chat_id, payload, expires_at] for chat_id, (payload, expires_at) in self._states.items()]
+            for i in range(0, len(states), 1000):
+                lines.append(_line({'s': states[i:i + 1000]}))
+            lines.append(_line({'r': list(self._recent)}))
+            lines.extend(_line({'i': update_id, 'update': update}) for update_id, update in self._pending.items())
+            # Знімок уже містить усе з буфера; стани незавершених обробок допише done()
+            self._buffer = []
+            data = ''.join(lines).encode()
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'ab')
+            self._size = len(data)
+        logger.info(f"Журнал {self.path} стиснуто до {len(data)} байт")
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            self.try_sync()
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class JournaledStore:
+    """Сховище сесій, що дописує кожен збережений стан у журнал."""
+
+    def __init__(self, store, journal):
+        self.store = store
+        self.journal = journal
+
+    @property
+    def blocking(self):
+        return self.store.blocking
+
+    @property
+    def local(self):
+        return self.store.local
+
+    def load(self, chat_id):
+        return self.store.load(chat_id)
+
+    def save(self, state):
+        self.store.save(state)
+        self.journal.record_state(state)
+
+    def delete(self, chat_id):
+        self.store.delete(chat_id)
+
+    def close(self):
+        self.store.close()
+
+
+def process_update(bot, journal, update):
+    """Обробляє оновлення TeleBot і позначає його обробленим навіть після помилки обробника."""
+    token = current_update.set(update.update_id)
+    try:
+        bot.process_new_updates([update])
+    finally:
+        current_update.reset(token)
+        journal.done(update.update_id)
+
+
+async def process_update_async(bot, journal, update):
+    """process_update для AsyncTeleBot."""
+    token = current_update.set(update.update_id)
+    try:
+        await bot.process_new_updates([update])
+    finally:
+        current_update.reset(token)
+        journal.done(update.update_id)
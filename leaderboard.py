@@ -0,0 +1,205 @@
+import heapq
+import os
+import threading
+import time
+from bisect import bisect_right, insort
+
+import aiodb
+import db
+
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 10))
+LEADERBOARD_REFRESH = float(os.environ.get('LEADERBOARD_REFRESH', 300))  # seconds
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', 60))  # seconds
+
+# Межі кошиків дистанції, км: 5K, 10K, напівмарафон, марафон
+DISTANCE_BUCKETS = (5, 10, 21.1, 42.2)
+
+# Найкраща спроба кожного учасника; умова event_id обмежує запит секцією події
+LEADERBOARD_QUERY = """
+    SELECT DISTINCT ON (chat_id) chat_id, name, surname, distance_km
+    FROM marathon_results
+    WHERE event_id = %s AND distance_km IS NOT NULL
+    ORDER BY chat_id, distance_km DESC
+"""
+RUNNER_STATS_QUERY = """
+    WITH best AS (
+        SELECT chat_id, max(distance_km) AS distance_km
+        FROM marathon_results
+        WHERE event_id = %(event_id)s AND distance_km IS NOT NULL
+        GROUP BY chat_id
+    )
+    SELECT b.distance_km,
+           (SELECT count(*) FROM best WHERE distance_km > b.distance_km) + 1,
+           (SELECT count(*) FROM best)
+    FROM best b
+    WHERE b.chat_id = %(chat_id)s
+"""
+
+
+def runner_label(name, surname, hidden_values):
+    """Ім'я та ініціал прізвища; None, якщо учасник не вказав імені."""
+    if not name or name in hidden_values:
+        return None
+    if surname and surname not in hidden_values:
+        return f"{name} {surname[0]}."
+    return name
+
+
+def bucket_index(distance):
+    return bisect_right(DISTANCE_BUCKETS, distance)
+
+
+class Leaderboard:
+    """Агрегати результатів у пам'яті: топ-N, загальна дистанція, кількість за кошиками і ранги."""
+
+    def __init__(self, size=LEADERBOARD_SIZE):
+        self.size = size
+        self._results = {}          # chat_id -> (distance, label)
+        self._sorted = []           # відсортовані дистанції для рангу за bisect
+        self._top = []              # мін-купа (distance, chat_id) розміром size
+        self._top_dirty = False
+        self._bucket_counts = [0] * (len(DISTANCE_BUCKETS) + 1)
+        self.total_distance = 0.0
+        self.event_id = None
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def _remove(self, chat_id, distance):
+        del self._sorted[bisect_right(self._sorted, distance) - 1]
+        self._bucket_counts[bucket_index(distance)] -= 1
+        self.total_distance -= distance
+        # Результат учасника міг бути у топі; купу перебудуємо при наступному читанні
+        if self._top and distance >= self._top[0][0]:
+            self._top_dirty = True
+
+    def _add(self, chat_id, distance, label):
+        self._results[chat_id] = (distance, label)
+        insort(self._sorted, distance)
+        self._bucket_counts[bucket_index(distance)] += 1
+        self.total_distance += distance
+        if self._top_dirty:
+            return
+        if len(self._top) < self.size:
+            heapq.heappush(self._top, (distance, chat_id))
+        elif distance > self._top[0][0]:
+            heapq.heapreplace(self._top, (distance, chat_id))
+
+    def record(self, chat_id, distance, label):
+        """Оновлює агрегати одним результатом; у таблиці лишається найкраща спроба учасника."""
+        with self._lock:
+            previous = self._results.get(chat_id)
+            if previous is not None:
+                if previous[0] >= distance:
+                    return
+                self._remove(chat_id, previous[0])
+            self._add(chat_id, distance, label)
+
+    def replace_all(self, rows, event_id=None):
+        """Завантажує агрегати події з рядків (chat_id, distance, label), наприклад із БД."""
+        fresh = Leaderboard(self.size)
+        for chat_id, distance, label in rows:
+            fresh._add(chat_id, distance, label)
+        with self._lock:
+            self._results, self._sorted, self._top = fresh._results, fresh._sorted, fresh._top
+            self._top_dirty = False
+            self._bucket_counts = fresh._bucket_counts
+            self.total_distance = fresh.total_distance
+            self.event_id = event_id
+            self.loaded_at = time.monotonic()
+
+    def top(self):
+        """Топ-N як список (distance, label) за спаданням дистанції; O(N log K) лише після заміни результату."""
+        with self._lock:
+            if self._top_dirty:
+                self._top = heapq.nlargest(self.size, ((d, c) for c, (d, _) in self._results.items()))
+                heapq.heapify(self._top)
+                self._top_dirty = False
+            return [(distance, self._results[chat_id][1]) for distance, chat_id in sorted(self._top, reverse=True)]
+
+    def stats(self, chat_id):
+        """(distance, rank, participants) для учасника або None."""
+        with self._lock:
+            result = self._results.get(chat_id)
+            if result is None:
+                return None
+            rank = len(self._sorted) - bisect_right(self._sorted, result[0]) + 1
+            return result[0], rank, len(self._sorted)
+
+    def bucket_counts(self):
+        with self._lock:
+            return list(self._bucket_counts)
+
+
+def leaderboard_text(board, texts):
+    """Відповідь на /leaderboard з агрегатів board; texts — messages.TEXTS мовою учасника."""
+    top = board.top()
+    if not top:
+        return texts['leaderboard_empty']
+    lines = [texts['leaderboard_title']]
+    lines.extend(texts['leaderboard_line'].format(place=place, label=label or texts['anonymous'], distance=distance)
+                 for place, (distance, label) in enumerate(top, 1))
+    lines.append('')
+    lines.append(texts['leaderboard_totals'].format(count=len(board), total=board.total_distance))
+    lines.append(texts['leaderboard_buckets'].format(*board.bucket_counts()))
+    return "\n".join(lines)
+
+
+class TTLCache:
+    """Невеликий кеш відповідей БД з часом життя записів."""
+
+    def __init__(self, ttl=STATS_CACHE_TTL, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries = {k: v for k, v in self._entries.items() if v[1] >= now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[key] = (value, now + self.ttl)
+
+
+def leaderboard_results(event_id, hidden_values):
+    cur = yield LEADERBOARD_QUERY, (event_id,)
+    return [(chat_id, float(distance), runner_label(name, surname, hidden_values))
+            for chat_id, name, surname, distance in cur]
+
+
+def runner_stats(event_id, chat_id):
+    cur = yield RUNNER_STATS_QUERY, {'event_id': event_id, 'chat_id': chat_id}
+    row = cur.fetchone()
+    return (float(row[0]), row[1], row[2]) if row else None
+
+
+def fetch_results(pool, event_id, hidden_values):
+    """Найкращі результати учасників події з БД у форматі для Leaderboard.replace_all."""
+    return db.run_queries(pool, leaderboard_results, event_id, hidden_values)
+
+
+def fetch_runner_stats(pool, event_id, chat_id):
+    """(distance, rank, participants) учасника в події з БД або None; читає лише секцію події."""
+    return db.run_queries(pool, runner_stats, event_id, chat_id)
+
+
+async def fetch_results_async(pool, event_id, hidden_values):
+    """fetch_results для асинхронного пулу aiodb."""
+    return await aiodb.run_queries(pool, leaderboard_results, event_id, hidden_values)
+
+
+async def fetch_runner_stats_async(pool, event_id, chat_id):
+    """fetch_runner_stats для асинхронного пулу aiodb."""
+    return await aiodb.run_queries(pool, runner_stats, event_id, chat_id)
@@ -0,0 +1,495 @@
+"""Навантажувальний тест бота без мережі: фальшивий Bot API, заглушка PostgreSQL і синтетичні учасники.
+
+    python loadtest.py --runners 500 --concurrency 50 [--mode webhook] [--runtime asyncio] [--db-latency 5] [--json report.json]
+
+Бот запускається окремим процесом, як у продакшні. Змінні середовища для нього передаються через
+--env KEY=VALUE (наприклад, --env OUTBOX_GLOBAL_RATE=1000, щоб виміряти бот без лімітів Telegram).
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPTS = {
+    'threads': os.path.join(BOT_DIR, 'marathon_bot.py'),
+    'asyncio': os.path.join(BOT_DIR, 'marathon_bot_async.py'),
+}
+BOT_TOKEN = '123456:loadtest'
+# Підміняємо адресу Bot API у процесі бота до імпорту marathon_bot (для обох клієнтів telebot)
+BOT_LAUNCHER = ("import sys, runpy, telebot.apihelper as api, telebot.asyncio_helper as aio; "
+                "api.API_URL = aio.API_URL = sys.argv[1]; runpy.run_path(sys.argv[2], run_name='__main__')")
+
+START_LOCATION = (50.4501, 30.5234)
+
+# (назва кроку, що надсилає учасник, скільки відповідей бота очікуємо)
+SCRIPT = (
+    ('/start', {'text': '/start'}, 1),
+    ('language', {'text': 'English'}, 1),
+    ('name', {'text': 'Ivan'}, 1),
+    ('surname', {'text': 'Petrenko'}, 1),
+    ('birth_day', {'text': '5'}, 1),
+    ('birth_month', {'text': '5'}, 1),
+    ('birth_year', {'text': '1990'}, 1),
+    ('phone', {'contact': {'phone_number': '+380501234567', 'first_name': 'Ivan'}}, 2),
+    ('start', {'location': START_LOCATION}, 1),
+    # Фініш: повідомлення про завершення, сертифікат (sendPhoto) і посилання на сайт
+    ('finish', {'location': (START_LOCATION[0] + 0.05, START_LOCATION[1] + 0.02)}, 3),
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Перцентиль за найближчим рангом для відсортованого списку."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+class FakeDatabase(socketserver.ThreadingTCPServer):
+    """Заглушка PostgreSQL: протокол v3 без автентифікації, кожен запит успішний.
+
+    SELECT повертає 0 рядків, а RETURNING і агрегати без GROUP BY — один рядок '1' (наприклад, id події).
+
+    Рахує виконані оператори за першим словом і може додавати затримку, щоб імітувати віддалену БД.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, latency=0.0):
+        super().__init__(('127.0.0.1', port), _DatabaseSession)
+        self.latency = latency
+        self.statements = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"postgresql://loadtest@127.0.0.1:{self.server_address[1]}/loadtest?sslmode=disable"
+
+    def record(self, verb):
+        with self._lock:
+            self.statements[verb] += 1
+
+
+class _DatabaseSession(socketserver.StreamRequestHandler):
+    PARAMETERS = {
+        'server_version': '16.0',
+        'server_encoding': 'UTF8',
+        'client_encoding': 'UTF8',
+        'DateStyle': 'ISO, MDY',
+        'integer_datetimes': 'on',
+        'standard_conforming_strings': 'on',
+        'TimeZone': 'UTC',
+    }
+    ONE_ROW = re.compile(r'\bRETURNING\b|^\s*SELECT\s+(coalesce\()?(max|min|count)\((?!.*\bGROUP\s+BY\b)',
+                         re.IGNORECASE | re.DOTALL)
+    # Ці оператори повертають тег з кількістю рядків
+    ROW_TAGS = {'INSERT': 'INSERT 0 1', 'EXECUTE': 'INSERT 0 1', 'UPDATE': 'UPDATE 1', 'DELETE': 'DELETE 0'}
+
+    def _send(self, kind, payload=b''):
+        self.wfile.write(kind + struct.pack('!i', len(payload) + 4) + payload)
+
+    def _startup(self):
+        while True:
+            length, code = struct.unpack('!ii', self.rfile.read(8))
+            body = self.rfile.read(length - 8)
+            if code in (80877103, 80877104):  # SSLRequest, GSSENCRequest
+                self.wfile.write(b'N')
+                continue
+            return body
+
+    def handle(self):
+        self._startup()
+        self._send(b'R', struct.pack('!i', 0))
+        for name, value in self.PARAMETERS.items():
+            self._send(b'S', name.encode() + b'\0' + value.encode() + b'\0')
+        self._send(b'K', struct.pack('!ii', os.getpid(), 0))
+        self._send(b'Z', b'I')
+        while True:
+            header = self.rfile.read(5)
+            if len(header) < 5 or header[:1] == b'X':
+                return
+            payload = self.rfile.read(struct.unpack('!i', header[1:])[0] - 4)
+            if header[:1] != b'Q':
+                self._send(b'E', b'SERROR\0C0A000\0Mloadtest stand-in supports only simple queries\0\0')
+                self._send(b'Z', b'I')
+                continue
+            self._query(payload.rstrip(b'\0').decode())
+            self.wfile.flush()
+
+    def _query(self, query):
+        words = query.split(None, 1)
+        if not words:
+            self._send(b'I')
+            self._send(b'Z', b'I')
+            return
+        verb = words[0].upper()
+        self.server.record(verb)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        one_row = self.ONE_ROW.search(query)
+        if verb == 'SELECT' or one_row:
+            # Один текстовий стовпець: fetchone() дає None або ('1',), ітерація — порожня або один рядок
+            self._send(b'T', struct.pack('!h', 1) + b'?column?\0' + struct.pack('!ihihih', 0, 0, 25, -1, -1, 0))
+            if one_row:
+                self._send(b'D', struct.pack('!hi', 1, 1) + b'1')
+            self._send(b'C', (self.ROW_TAGS.get(verb, verb) if verb != 'SELECT' else f'SELECT {int(bool(one_row))}').encode() + b'\0')
+        else:
+            self._send(b'C', self.ROW_TAGS.get(verb, verb).encode() + b'\0')
+        self._send(b'Z', b'I')
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Фальшивий Bot API: віддає getUpdates з черги, записує sendMessage та інші виклики бота."""
+
+    daemon_threads = True
+    # Асинхронний бот відкриває десятки з'єднань одночасно; черга listen() на 5 дає затримки в секунду на SYN
+    request_queue_size = 128
+
+    def __init__(self, port, token, on_message):
+        super().__init__(('127.0.0.1', port), _BotAPIHandler)
+        self.token = token
+        self.on_message = on_message
+        self.calls = Counter()
+        self.polled = threading.Event()
+        self._updates = deque()
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot{{0}}/{{1}}"
+
+    def push(self, update):
+        with self._cond:
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                # Як і Telegram, offset підтверджує всі попередні оновлення
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.popleft()
+                if self._updates or time.monotonic() >= deadline:
+                    return list(itertools.islice(self._updates, limit))
+                self._cond.wait(deadline - time.monotonic())
+
+    def call(self, method, params):
+        with self._cond:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            self.polled.set()
+            return self.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)),
+                                    float(params.get('timeout', 0)))
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Marathon', 'username': 'marathon_loadtest_bot'}
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.on_message(chat_id, params.get('text', ''), 'reply_markup' in params)
+            return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        if method == 'sendPhoto':
+            chat_id = int(params['chat_id'])
+            self.on_message(chat_id, params.get('caption', ''), 'reply_markup' in params)
+            message_id = next(self._message_ids)
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'photo': [{'file_id': f'photo-{message_id}', 'file_unique_id': f'photo-{message_id}',
+                               'width': 1600, 'height': 1131}]}
+        return True
+
+
+class _BotAPIHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        prefix, _, method = url.path.rpartition('/')
+        if prefix != f'/bot{self.server.token}':
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params.update(json.loads(body))
+            elif content_type.startswith('multipart/form-data'):
+                # Завантаження файлів (sendPhoto); вміст файлу не потрібен, лише поля запиту
+                form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+                for part in form.iter_parts():
+                    name = part.get_param('name', header='content-disposition')
+                    params[name] = part.get_payload(decode=True) if part.get_filename() else part.get_content()
+            else:
+                params.update(parse_qsl(body.decode()))
+        self._reply(200, {'ok': True, 'result': self.server.call(method, params)})
+
+    do_GET = do_POST = _handle
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LoadTest:
+    """Проводить учасників сценарієм SCRIPT і збирає затримки кожного кроку.
+
+    Затримка кроку — від передачі оновлення боту до останньої очікуваної відповіді.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.completed = 0
+        self.messages = 0
+        self._waiting = {}      # chat_id -> [remaining, event]
+        self._update_ids = itertools.count(1)
+        self._next_runner = itertools.count()
+        self._lock = threading.Lock()
+        self.database = FakeDatabase(free_port(), args.db_latency / 1000)
+        self.api = FakeBotAPI(free_port(), BOT_TOKEN, self.on_message)
+        self.webhook_port = free_port()
+        self.workdir = tempfile.mkdtemp(prefix='marathon-loadtest-')
+        self.bot = None
+
+    def on_message(self, chat_id, text, has_markup):
+        with self._lock:
+            self.messages += 1
+            waiting = self._waiting.get(chat_id)
+            if waiting is None or waiting[0] <= 0:
+                self.errors['unexpected_reply'] += 1
+                return
+            waiting[0] -= 1
+            if waiting[0] == 0:
+                waiting[1].set()
+
+    def start(self):
+        for server in (self.database, self.api):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        env = dict(os.environ, BOT_TOKEN=BOT_TOKEN, DATABASE_URL=self.database.url, BOT_MODE=self.args.mode,
+                   PORT=str(self.webhook_port), PYTHONPATH=BOT_DIR)
+        env.pop('WEBHOOK_URL', None)
+        env.update(item.split('=', 1) for item in self.args.env)
+        self.log = open(os.path.join(self.workdir, 'bot.log'), 'wb')
+        # cwd — тимчасовий каталог, щоб CSV-спул бота не змішувався з робочими файлами
+        self.bot = subprocess.Popen([sys.executable, '-c', BOT_LAUNCHER, self.api.url, BOT_SCRIPTS[self.args.runtime]],
+                                    cwd=self.workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.bot.poll() is not None:
+                raise RuntimeError(f"Бот завершився під час запуску, див. {self.log.name}")
+            if self.args.mode == 'webhook':
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{self.webhook_port}/healthz", timeout=1).close()
+                    return
+                except OSError:
+                    pass
+            elif self.api.polled.is_set():
+                return
+            time.sleep(0.1)
+        raise RuntimeError(f"Бот не запустився за {timeout} с, див. {self.log.name}")
+
+    def stop(self, timeout=30):
+        """Зупиняє бот як Ctrl+C, щоб він дописав результати в БД і надіслав залишок черги."""
+        if self.bot is not None and self.bot.poll() is None:
+            self.bot.send_signal(signal.SIGINT)
+            try:
+                self.bot.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.bot.kill()
+                self.bot.wait()
+        self.api.shutdown()
+        self.database.shutdown()
+        self.log.close()
+
+    def update(self, chat_id, step):
+        message = {'message_id': next(self._update_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Runner'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Runner'}}
+        if 'text' in step:
+            message['text'] = step['text']
+            if step['text'].startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(step['text'])}]
+        if 'contact' in step:
+            message['contact'] = dict(step['contact'], user_id=chat_id)
+        if 'location' in step:
+            latitude, longitude = step['location']
+            message['location'] = {'latitude': latitude, 'longitude': longitude}
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def deliver(self, update):
+        if self.args.mode == 'webhook':
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{self.webhook_port}/telegram", data=json.dumps(update).encode(),
+                headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request, timeout=self.args.step_timeout).close()
+        else:
+            self.api.push(update)
+
+    def run_runner(self, chat_id):
+        for name, step, replies in SCRIPT:
+            event = threading.Event()
+            with self._lock:
+                self._waiting[chat_id] = [replies, event]
+            started = time.monotonic()
+            try:
+                self.deliver(self.update(chat_id, step))
+            except (OSError, urllib.error.HTTPError) as e:
+                logger.debug(f"Оновлення {name} для {chat_id} не доставлено: {e}")
+                self.errors[f'deliver:{name}'] += 1
+                return False
+            if not event.wait(self.args.step_timeout):
+                self.errors[f'timeout:{name}'] += 1
+                return False
+            with self._lock:
+                self.latencies[name].append(time.monotonic() - started)
+            if self.args.think_time:
+                time.sleep(self.args.think_time)
+        with self._lock:
+            self._waiting.pop(chat_id, None)
+            self.completed += 1
+        return True
+
+    def _worker(self):
+        while True:
+            index = next(self._next_runner)
+            if index >= self.args.runners:
+                return
+            self.run_runner(self.args.first_chat_id + index)
+
+    def run(self):
+        self.start()
+        started = time.monotonic()
+        try:
+            workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.args.concurrency)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.elapsed = time.monotonic() - started
+        finally:
+            self.stop()
+        return self.report()
+
+    def report(self):
+        steps = {}
+        for name, _, _ in SCRIPT:
+            values = sorted(self.latencies[name])
+            steps[name] = {
+                'count': len(values),
+                'p50_ms': _ms(percentile(values, 0.50)),
+                'p90_ms': _ms(percentile(values, 0.90)),
+                'p99_ms': _ms(percentile(values, 0.99)),
+                'max_ms': _ms(values[-1] if values else None),
+            }
+        updates = sum(step['count'] for step in steps.values())
+        return {
+            'mode': self.args.mode,
+            'runners': self.args.runners,
+            'concurrency': self.args.concurrency,
+            'completed': self.completed,
+            'elapsed_s': round(self.elapsed, 3),
+            'runners_per_s': round(self.completed / self.elapsed, 2),
+            'updates_per_s': round(updates / self.elapsed, 2),
+            'messages_sent': self.messages,
+            'steps': steps,
+            'errors': dict(self.errors),
+            'api_calls': dict(self.api.calls),
+            'db_statements': dict(self.database.statements),
+            'bot_exit_code': self.bot.returncode,
+            # У режимі webhook KeyboardInterrupt не перехоплюється, тож код -SIGINT теж означає штатну зупинку
+            'bot_clean_exit': self.bot.returncode in (0, -signal.SIGINT),
+            'bot_log': self.log.name,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(report):
+    print(f"Режим: {report['mode']}, учасників: {report['runners']}, одночасно: {report['concurrency']}")
+    print(f"Завершили сценарій: {report['completed']} за {report['elapsed_s']} с "
+          f"({report['runners_per_s']} учасників/с, {report['updates_per_s']} оновлень/с, "
+          f"надіслано повідомлень: {report['messages_sent']})")
+    print(f"{'крок':<12}{'n':>7}{'p50, мс':>10}{'p90, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, step in report['steps'].items():
+        cells = ''.join(f"{'-' if step[key] is None else step[key]:>10}" for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        print(f"{name:<12}{step['count']:>7}{cells}")
+    print("Помилки:", ', '.join(f"{key}={value}" for key, value in sorted(report['errors'].items())) or 'немає')
+    print("Bot API:", ', '.join(f"{key}={value}" for key, value in sorted(report['api_calls'].items())))
+    print("PostgreSQL:", ', '.join(f"{key}={value}" for key, value in sorted(report['db_statements'].items())))
+    if not report['bot_clean_exit']:
+        print(f"Бот завершився з кодом {report['bot_exit_code']}, журнал: {report['bot_log']}")
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Навантажувальний тест марафонського бота з фальшивим Bot API")
+    parser.add_argument('--runners', type=int, default=100, help="скільки учасників проходять сценарій")
+    parser.add_argument('--concurrency', type=int, default=20, help="скільки учасників проходять його одночасно")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--runtime', choices=tuple(BOT_SCRIPTS), default='threads',
+                        help="marathon_bot.py (threads) чи marathon_bot_async.py (asyncio)")
+    parser.add_argument('--think-time', type=float, default=0, help="пауза учасника між кроками, с")
+    parser.add_argument('--step-timeout', type=float, default=60, help="скільки чекати відповіді на крок, с")
+    parser.add_argument('--db-latency', type=float, default=0, help="затримка заглушки PostgreSQL на запит, мс")
+    parser.add_argument('--first-chat-id', type=int, default=10_000_000)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="змінна середовища для процесу бота, можна повторювати")
+    parser.add_argument('--json', metavar='PATH', help="записати звіт у JSON, щоб порівнювати запуски")
+    args = parser.parse_args(argv)
+
+    test = LoadTest(args)
+    report = test.run()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    failed = bool(report['errors']) or report['completed'] < args.runners or not report['bot_clean_exit']
+    if not failed:
+        shutil.rmtree(test.workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""Службові команди для організаторів марафону.
+
+    python manage.py migrate
+    python manage.py event create SLUG --title TITLE --starts DATE [--ends DATE]
+    python manage.py event list
+    python manage.py validate [--event SLUG] [--chunk-size 5000] [--course COURSE.geojson --event SLUG]
+    python manage.py export OUTPUT_DIR [--event SLUG] [--format csv|jsonl] [--gzip] [--chunk-rows N] [--from DATE] [--to DATE] [--since-last NAME]
+"""
+import argparse
+import datetime
+import logging
+import math
+import os
+import sys
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+import course
+import db
+import events
+import export
+import geo
+import migrations
+import tracks
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+VALIDATE_QUERY = """
+    SELECT event_id, chat_id, attempt, start_latitude, start_longitude, finish_latitude, finish_longitude,
+           EXTRACT(EPOCH FROM finish_time - start_time), track_polyline
+    FROM marathon_results
+"""
+# Стовпці VALIDATE_QUERY після ключа (event_id, chat_id, attempt)
+_START_LAT, _START_LON, _FINISH_LAT, _FINISH_LON, _DURATION, _TRACK = range(3, 9)
+
+
+def iter_chunks(conn, query, chunk_size, params=None):
+    """Читає результат запиту серверним курсором частинами по chunk_size рядків."""
+    with conn.cursor(name='manage_stream') as cur:
+        cur.itersize = chunk_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+def _column(rows, index):
+    return np.array([np.nan if row[index] is None else float(row[index]) for row in rows], dtype=np.float64)
+
+
+def _nullable(value):
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+def course_flags(event_course, row, track=None):
+    """Прапорці траси для рядка VALIDATE_QUERY; допуск зон — найбільший, з яким геопозицію міг прийняти бот."""
+    flags = 0
+    for lat, lon, in_zone in ((row[_START_LAT], row[_START_LON], event_course.in_start_zone),
+                              (row[_FINISH_LAT], row[_FINISH_LON], event_course.in_finish_zone)):
+        if lat is not None and lon is not None and not in_zone(float(lat), float(lon), course.COURSE_MAX_ACCURACY_M):
+            flags |= geo.FLAG_OUTSIDE_ZONE
+    # Контрольні точки й маршрут можна перевірити лише за треком
+    if track is not None:
+        check = event_course.check_track(track.lats, track.lons)
+        if check.missed:
+            flags |= geo.FLAG_MISSED_CHECKPOINT
+        if check.off_route_points:
+            flags |= geo.FLAG_OFF_ROUTE
+    return flags
+
+
+def validate_chunk(rows, event_course=None):
+    """Повертає вердикти у порядку db.VALIDATION_COLUMNS для пачки рядків VALIDATE_QUERY."""
+    # Усі треки пачки складаються в один масив, щоб перевірити їх точки одним проходом
+    track_rows, lats, lons, times, offsets = [], [], [], [], []
+    decoded = {}
+    size = 0
+    for i, row in enumerate(rows):
+        if row[_TRACK]:
+            track = tracks.decode(row[_TRACK])
+            if len(track):
+                decoded[i] = track
+                track_rows.append(i)
+                offsets.append(size)
+                lats.append(track.lats)
+                lons.append(track.lons)
+                times.append(track.times)
+                size += len(track)
+
+    track_distance = np.full(len(rows), np.nan)
+    max_track_speed = np.full(len(rows), np.nan)
+    track_flags = np.zeros(len(rows), dtype=np.int32)
+    if track_rows:
+        distance, max_speed, flags = geo.validate_tracks(
+            np.concatenate(lats), np.concatenate(lons), np.concatenate(times), offsets)
+        track_distance[track_rows] = distance
+        max_track_speed[track_rows] = max_speed
+        track_flags[track_rows] = flags
+
+    distance, speed, pace, flags = geo.validate_runs(
+        _column(rows, _START_LAT), _column(rows, _START_LON), _column(rows, _FINISH_LAT), _column(rows, _FINISH_LON),
+        _column(rows, _DURATION), track_distance)
+    flags |= track_flags
+    if event_course is not None:
+        flags |= np.array([course_flags(event_course, row, decoded.get(i)) for i, row in enumerate(rows)],
+                          dtype=np.int32)
+    return [
+        (*row[:3], _nullable(distance[i]), _nullable(speed[i]), _nullable(pace[i]),
+         _nullable(max_track_speed[i]), int(flags[i]))
+        for i, row in enumerate(rows)
+    ]
+
+
+def _prepare(event_slug=None):
+    """Застосовує міграції й повертає id події event_slug (None, якщо її не задано)."""
+    pool = db.ConnectionPool(DATABASE_URL, minconn=1, maxconn=1)
+    try:
+        migrations.migrate(pool)
+        if event_slug is None:
+            return None
+        event_id = events.find_event(pool, event_slug)
+    finally:
+        pool.close()
+    if event_id is None:
+        raise SystemExit(f"Подію {event_slug!r} не знайдено, див. python manage.py event list")
+    return event_id
+
+
+def cmd_validate(args):
+    event_id = _prepare(args.event)
+    event_course = course.load(args.course)
+    query, params = VALIDATE_QUERY, None
+    if event_id is not None:
+        query, params = VALIDATE_QUERY + " WHERE event_id = %s", (event_id,)
+    read_conn = psycopg2.connect(DATABASE_URL)
+    write_conn = psycopg2.connect(DATABASE_URL)
+    write_conn.autocommit = True
+    total = flagged = 0
+    try:
+        for rows in iter_chunks(read_conn, query, args.chunk_size, params):
+            verdicts = validate_chunk(rows, event_course)
+            with write_conn.cursor() as cur:
+                execute_values(cur, db.SAVE_VALIDATIONS, verdicts, page_size=len(verdicts))
+            total += len(verdicts)
+            flagged += sum(1 for verdict in verdicts if verdict[-1])
+            logger.info(f"Перевірено {total} результатів")
+    finally:
+        read_conn.close()
+        write_conn.close()
+    print(f"Перевірено результатів: {total}, з підозрілими прапорцями: {flagged}")
+
+
+def cmd_export(args):
+    event_id = _prepare(args.event)
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        result = export.export_results(
+            conn, args.output_dir, fmt=args.format, compress=args.gzip, chunk_rows=args.chunk_rows,
+            event_id=event_id, date_from=args.date_from, date_to=args.date_to, cursor_name=args.since_last)
+    finally:
+        conn.close()
+    print(f"Експортовано результатів: {result.rows}, файлів: {len(result.paths)}")
+    for path in result.paths:
+        print(path)
+
+
+def cmd_migrate(args):
+    _prepare()
+    print("Схему оновлено")
+
+
+def cmd_event_create(args):
+    _prepare()
+    pool = db.ConnectionPool(DATABASE_URL, minconn=1, maxconn=1)
+    try:
+        event_id = events.create_event(pool, args.slug, args.title, args.starts, args.ends or args.starts)
+    finally:
+        pool.close()
+    print(f"Подія {args.slug}: id {event_id}")
+
+
+def cmd_event_list(args):
+    _prepare()
+    pool = db.ConnectionPool(DATABASE_URL, minconn=1, maxconn=1)
+    try:
+        rows = events.list_events(pool)
+    finally:
+        pool.close()
+    for event_id, slug, title, starts_on, ends_on, results in rows:
+        print(f"{event_id:>4}  {slug:<24} {starts_on}..{ends_on}  результатів: {results:<8} {title}")
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Службові команди марафонського бота")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate = commands.add_parser('migrate', help="застосувати міграції схеми")
+    migrate.set_defaults(func=cmd_migrate)
+
+    event = commands.add_parser('event', help="події (марафони)")
+    event_commands = event.add_subparsers(dest='event_command', required=True)
+    event_create = event_commands.add_parser('create', help="створити подію або оновити назву й дати")
+    event_create.add_argument('slug')
+    event_create.add_argument('--title', required=True)
+    event_create.add_argument('--starts', type=datetime.date.fromisoformat, required=True, help="YYYY-MM-DD")
+    event_create.add_argument('--ends', type=datetime.date.fromisoformat, help="YYYY-MM-DD, типово дорівнює --starts")
+    event_create.set_defaults(func=cmd_event_create)
+    event_list = event_commands.add_parser('list', help="показати події")
+    event_list.set_defaults(func=cmd_event_list)
+
+    validate = commands.add_parser('validate', help="перерахувати дистанції та перевірити результати на правдоподібність")
+    validate.add_argument('--event', metavar='SLUG', help="лише результати цієї події")
+    validate.add_argument('--chunk-size', type=int, default=5000)
+    validate.add_argument('--course', metavar='GEOJSON',
+                          help="перевірити зони старту і фінішу, контрольні точки й маршрут події з --event")
+    validate.set_defaults(func=cmd_validate)
+
+    export_parser = commands.add_parser('export', help="вивантажити результати у CSV/JSONL через COPY")
+    export_parser.add_argument('output_dir')
+    export_parser.add_argument('--event', metavar='SLUG', help="лише результати цієї події")
+    export_parser.add_argument('--format', choices=export.EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--gzip', action='store_true', help="стискати файли gzip")
+    export_parser.add_argument('--chunk-rows', type=int, default=None, help="ділити на файли по N рядків")
+    export_parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat,
+                               help="дата забігу від (YYYY-MM-DD)")
+    export_parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat,
+                               help="дата забігу до включно (YYYY-MM-DD)")
+    export_parser.add_argument('--since-last', metavar='NAME',
+                               help="лише зміни після попереднього експорту з курсором NAME (наприклад, partner); "
+                                    "зміни за останні EXPORT_CURSOR_LAG секунд повторюються в наступному; з --event курсор "
+                                    "свій у кожної події")
+    export_parser.set_defaults(func=cmd_export)
+
+    args = parser.parse_args(argv)
+    # Траса належить одній події: без --event її геометрія позначила б результати всіх попередніх подій
+    if args.command == 'validate' and args.course and args.event is None:
+        parser.error("--course потребує --event: траса стосується лише однієї події")
+    if DATABASE_URL is None:
+        logger.error("Error: DATABASE_URL environment variable not set!")
+        return 1
+    args.func(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
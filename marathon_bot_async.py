@@ -0,0 +1,352 @@
+"""Асинхронний варіант marathon_bot.py на AsyncTeleBot: один потік і цикл подій asyncio замість пулів потоків.
+
+    python3 marathon_bot_async.py
+
+Розмова, тексти, кроки (спільні обробники в conversation.py), таблиця лідерів і формат результатів ті самі,
+що й у marathon_bot.py; змінні середовища теж. Обробники — корутини: очікування Bot API і PostgreSQL не займає потоків, тож тисячі
+одночасних розмов обслуговує один процес. Оновлення одного чату обробляються по черзі в обох режимах.
+"""
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import tempfile
+import time
+
+import psycopg2
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+import aiodb
+import certificates
+import conversation
+import course
+import db
+import events
+import export
+import journal
+import messages
+import metrics
+import migrations
+import session_store
+import tracks
+import webhook
+from leaderboard import (LEADERBOARD_REFRESH, Leaderboard, TTLCache, fetch_results_async, fetch_runner_stats_async,
+                         leaderboard_text)
+from outbox import PRIORITY_BULK, AsyncOutbox
+from result_writer import AsyncResultWriter
+from session_store import RunnerState
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+log_queue = queue.SimpleQueue()
+log_handler = logging.handlers.QueueHandler(log_queue)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+# Процеси пулу сертифікатів створюються fork найпершими, до потоку логування, сховища сесій і з'єднань:
+# дочірній процес, що успадкував замок, захоплений іншим потоком, завис би на ньому
+certificate_renderer = certificates.CertificateRenderer().start()
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.environ.get('BOT_TOKEN')
+if BOT_TOKEN is None:
+    logger.error("Error: BOT_TOKEN environment variable not set!")
+    exit(1)
+
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 20))  # seconds, довге опитування getUpdates
+
+bot = AsyncTeleBot(BOT_TOKEN)
+outbox = AsyncOutbox(bot)
+update_journal = journal.Journal()
+store = session_store.from_url()
+if update_journal.path:
+    store = journal.JournaledStore(store, update_journal)
+sessions = session_store.AsyncSessions(store)
+# Оновлення різних чатів обробляються конкурентно, одного чату — по черзі
+update_tasks = webhook.ChatOrderedTasks()
+
+CSV_FILE = 'marathon_results.csv'
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+ADMIN_CHAT_IDS = frozenset(int(chat_id) for chat_id in os.environ.get('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip())
+db_pool = aiodb.ConnectionPool(DATABASE_URL)
+current_event = events.AsyncCurrentEvent(db_pool)
+result_writer = AsyncResultWriter(db_pool, CSV_FILE, resolve_event=current_event.get)
+live_tracks = tracks.TrackRegistry()
+event_course = course.load()
+shared_files = certificates.AsyncFileIds(bot)
+leaderboard = Leaderboard()
+runner_stats = TTLCache()
+_leaderboard_refresh = asyncio.Lock()
+_background = set()
+
+metrics.QUEUE_DEPTH.track('outbox', func=outbox.backlog)
+metrics.QUEUE_DEPTH.track('result_writer', func=result_writer.backlog)
+metrics.QUEUE_DEPTH.track('live_tracks', func=lambda: len(live_tracks))
+metrics.QUEUE_DEPTH.track('certificates', func=certificate_renderer.backlog)
+metrics.QUEUE_DEPTH.track('updates', func=update_tasks.backlog)
+# Кроки розмови спільні з marathon_bot.py; AsyncOutbox не потокобезпечний, тож готовий сертифікат
+# надсилається з циклу подій
+steps = conversation.Conversation(
+    outbox, result_writer, live_tracks, leaderboard, event_course, certificate_renderer, shared_files,
+    when_done=lambda future, callback: asyncio.wrap_future(future).add_done_callback(callback))
+
+
+def in_background(coro):
+    """Запускає корутину, не чекаючи на неї; посилання тримаємо, щоб задачу не прибрав збирач сміття."""
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def next_attempt(previous, event_id, chat_id):
+    """Номер спроби для нового забігу: незавершена спроба повторюється, після фінішу — наступна."""
+    attempt = conversation.attempt_from_session(previous, event_id)
+    if attempt is not None or event_id is None:
+        return attempt
+    try:
+        return await events.next_attempt_async(db_pool, event_id, chat_id)
+    except psycopg2.Error as e:
+        logger.error(f"Не вдалося визначити номер спроби для {chat_id}: {e}")
+        return None
+
+
+@bot.message_handler(commands=['start'])
+@metrics.timed('start')
+async def start(message):
+    chat_id = message.chat.id
+    previous = await sessions.load(chat_id)
+    # Трек попередньої спроби, що не дійшла до фінішу, новому забігу не належить
+    live_tracks.pop(chat_id)
+    if previous is not None and previous.step is not None:
+        metrics.REGISTRATIONS.inc('abandoned')
+    metrics.REGISTRATIONS.inc('started')
+    event_id = await current_event.get()
+    await sessions.save(RunnerState(chat_id, step='language', event_id=event_id,
+                                    attempt=await next_attempt(previous, event_id, chat_id)))
+    outbox.send_message(chat_id, messages.WELCOME, reply_markup=messages.LANGUAGE_KEYBOARD)
+
+
+async def refresh_leaderboard():
+    """Перечитує агрегати з БД; одночасно виконується не більше одного оновлення."""
+    if _leaderboard_refresh.locked():
+        return
+    async with _leaderboard_refresh:
+        try:
+            event_id = await current_event.get()
+            if event_id is not None:
+                rows = await fetch_results_async(db_pool, event_id, messages.NOT_PROVIDED_TEXTS)
+                leaderboard.replace_all(rows, event_id)
+        except psycopg2.Error as e:
+            logger.error(f"Не вдалося завантажити таблицю лідерів: {e}")
+
+
+async def session_language(chat_id):
+    state = await sessions.load(chat_id)
+    return state.language if state and state.language else 'uk'
+
+
+@bot.message_handler(commands=['leaderboard'])
+@metrics.timed('leaderboard')
+async def show_leaderboard(message):
+    loaded_at = leaderboard.loaded_at
+    if (loaded_at is None or time.monotonic() - loaded_at > LEADERBOARD_REFRESH
+            or leaderboard.event_id != await current_event.get()):
+        in_background(refresh_leaderboard())
+    texts = messages.TEXTS[await session_language(message.chat.id)]
+    outbox.send_message(message.chat.id, leaderboard_text(leaderboard, texts))
+
+
+@bot.message_handler(commands=['mystats'])
+@metrics.timed('mystats')
+async def show_runner_stats(message):
+    chat_id = message.chat.id
+    texts = messages.TEXTS[await session_language(chat_id)]
+    event_id = await current_event.get()
+    stats = leaderboard.stats(chat_id) if leaderboard.event_id == event_id else None
+    if stats is None and event_id is not None:
+        stats = runner_stats.get((event_id, chat_id))
+        if stats is None:
+            try:
+                stats = await fetch_runner_stats_async(db_pool, event_id, chat_id) or ()
+            except psycopg2.Error as e:
+                logger.error(f"Не вдалося отримати результат учасника {chat_id}: {e}")
+                stats = ()
+            else:
+                runner_stats.put((event_id, chat_id), stats)
+    if not stats:
+        outbox.send_message(chat_id, texts['mystats_none'])
+        return
+    distance, rank, count = stats
+    outbox.send_message(chat_id, texts['mystats'].format(distance=distance, rank=rank, count=count))
+
+
+async def send_export_file(chat_id, path):
+    with open(path, 'rb') as document:
+        return await bot.send_document(chat_id, document, visible_file_name=os.path.basename(path))
+
+
+def write_export_files(directory, options):
+    # COPY недоступний в асинхронному режимі psycopg2, тож експорт іде звичайним з'єднанням у потоці
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        return export.export_results(conn, directory, compress=True, chunk_rows=export.EXPORT_CHUNK_ROWS, **options)
+    finally:
+        conn.close()
+
+
+async def run_export(chat_id, options):
+    directory = tempfile.mkdtemp(prefix='marathon-export-')
+    try:
+        result = await asyncio.to_thread(write_export_files, directory, options)
+        futures = conversation.queue_export(outbox, chat_id, result, send_export_file)
+        await asyncio.gather(*futures, return_exceptions=True)
+    except (psycopg2.Error, OSError) as e:
+        logger.error(f"Не вдалося виконати експорт для {chat_id}: {e}")
+        outbox.send_message(chat_id, messages.EXPORT_FAILED.format(error=e), priority=PRIORITY_BULK)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@bot.message_handler(commands=['export'], func=lambda message: message.chat.id in ADMIN_CHAT_IDS)
+@metrics.timed('export')
+async def export_results(message):
+    try:
+        options = export.parse_command_args(message.text.split()[1:])
+    except ValueError:
+        outbox.send_message(message.chat.id, messages.EXPORT_USAGE)
+        return
+    # Вивантажуються результати поточної події
+    options['event_id'] = await current_event.get()
+    if options['event_id'] is None:
+        outbox.send_message(message.chat.id, messages.EXPORT_NO_EVENT)
+        return
+    outbox.send_message(message.chat.id, messages.EXPORT_STARTED)
+    # Експорт не тримає чергу оновлень чату адміністратора
+    in_background(run_export(message.chat.id, options))
+
+
+@bot.edited_message_handler(content_types=['location'])
+@metrics.timed('live_location')
+async def handle_live_location(message):
+    steps.handle_live_location(message)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == 'already_registered')
+@metrics.timed('already_registered')
+async def handle_already_registered(call):
+    chat_id = call.message.chat.id
+    language = await session_language(chat_id)
+    outbox.send_message(chat_id, messages.TEXTS[language]['glory'], reply_markup=messages.REMOVE_KEYBOARD)
+
+
+@bot.message_handler(content_types=['text', 'contact', 'location'])
+async def dispatch_step(message):
+    state = await sessions.load(message.chat.id)
+    handler = steps.handler(state.step) if state is not None else None
+    if handler is None:
+        return
+    step = state.step
+    started = time.perf_counter()
+    handler(message, state)
+    await sessions.save(state)
+    metrics.observe_handler(handler.__name__, step, time.perf_counter() - started, message.chat.id)
+
+
+def dispatch_update(update):
+    update_tasks.submit(webhook.update_chat_id(update), journal.process_update_async, bot, update_journal, update)
+
+
+async def restore_from_journal():
+    """Повертає стани з відкритого журналу у сховище, дописує можливо втрачені фініші і доробляє перервані оновлення."""
+    # Спільне сховище (SQLite, Redis) пережило перезапуск і могло отримати новіші стани від інших воркерів
+    states = update_journal.states() if store.local else []
+    for state in states:
+        await asyncio.to_thread(store.store.save, state)
+    for state in update_journal.finished_since_snapshot():
+        result_writer.submit(db.result_row(state))
+    pending = update_journal.pending()
+    if states or pending:
+        logger.warning(f"Відновлено з журналу: {len(states)} станів, {len(pending)} необроблених оновлень")
+    for raw in pending:
+        dispatch_update(types.Update.de_json(raw))
+
+
+async def poll_updates():
+    """Довге опитування getUpdates; offset підтверджує оновлення лише після того, як вони записані в журнал."""
+    offset = update_journal.offset
+    while True:
+        try:
+            raw_updates = await asyncio_helper.get_updates(BOT_TOKEN, offset, None, POLLING_TIMEOUT,
+                                                           request_timeout=POLLING_TIMEOUT + 5)
+        except Exception as e:
+            logger.error(f"Не вдалося отримати оновлення: {e}")
+            await asyncio.sleep(3)
+            continue
+        if not raw_updates:
+            continue
+        offset = raw_updates[-1]['update_id'] + 1
+        fresh = update_journal.received(raw_updates, offset)
+        await asyncio.to_thread(update_journal.try_sync)
+        for raw in fresh:
+            dispatch_update(types.Update.de_json(raw))
+
+
+def run_migrations():
+    pool = db.ConnectionPool(DATABASE_URL, minconn=0, maxconn=1)
+    try:
+        migrations.migrate(pool)
+    finally:
+        pool.close()
+
+
+async def main():
+    # Журнал відкривається до з'єднань і задач бота: другий процес з тим самим JOURNAL_PATH одразу зупиняється
+    try:
+        await asyncio.to_thread(update_journal.open)
+    except journal.JournalLocked as e:
+        logger.error(str(e))
+        await asyncio.to_thread(certificate_renderer.close)
+        exit(1)
+    try:
+        await db_pool.warm_up()
+        await asyncio.to_thread(run_migrations)
+    except psycopg2.Error as e:
+        logger.error(f"Не вдалося відкрити з'єднання з PostgreSQL під час запуску: {e}")
+    await refresh_leaderboard()
+    try:
+        metrics.start_server()
+    except OSError as e:
+        logger.error(f"Не вдалося запустити ендпоінт метрик: {e}")
+    result_writer.start()
+    outbox.start()
+    try:
+        await restore_from_journal()
+        if BOT_MODE == 'webhook':
+            await webhook.serve_async(bot, update_tasks, update_journal, WEBHOOK_URL)
+        else:
+            await poll_updates()
+    finally:
+        await update_tasks.join(timeout=10)
+        await asyncio.to_thread(update_journal.close)
+        await asyncio.to_thread(certificate_renderer.close)
+        await outbox.close()
+        await result_writer.close()
+        db_pool.close()
+        sessions.close()
+        await bot.close_session()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,156 @@
+from telebot import types
+
+UKRAINIAN_RUN_URL = "https://www.ukrainian.run/#registration"
+ENGLISH_RUN_URL = "https://www.ukrainian.run/en/#registration"
+
+WELCOME = "Вітаємо Вас на «Марафоні Героїв»!\nWelcome to the «Heroes Marathon»!\n\nБудь ласка, оберіть мову.\nPlease select your language."
+CHOOSE_LANGUAGE = "Будь ласка, оберіть мову з наданих варіантів.\nPlease select a language from the options provided."
+LANGUAGES = {"Українська": 'uk', "English": 'en'}
+
+# Службові команди організаторів лише українською
+EXPORT_USAGE = "Використання: /export [all | YYYY-MM-DD | YYYY-MM-DD..YYYY-MM-DD] [csv | jsonl]\nВивантажуються результати поточної події. Без дати — зміни після попереднього /export; найсвіжіші з них повторяться в наступному."
+EXPORT_NO_EVENT = "Не вдалося виконати експорт: поточна подія невідома, PostgreSQL недоступна."
+EXPORT_STARTED = "Експорт розпочато, файли надійдуть окремими повідомленнями."
+EXPORT_EMPTY = "Нових результатів для експорту немає."
+EXPORT_DONE = "Експортовано результатів: {rows}, файлів: {files}."
+EXPORT_FAILED = "Не вдалося виконати експорт: {error}"
+
+# Тексти з {current_year} форматуються під час надсилання
+TEXTS = {
+    'uk': {
+        'skip': "Пропустити",
+        'not_provided': "Не вказано",
+        'language_selected': "Ви обрали українську мову.\nБудь ласка, введіть своє ім’я.",
+        'invalid_name': "Будь ласка, введіть коректне ім'я (тільки літери, мінімум 2 символи).",
+        'ask_surname': "Будь ласка, введіть своє прізвище.",
+        'invalid_surname': "Будь ласка, введіть коректне прізвище (тільки літери, мінімум 2 символи).",
+        'ask_birth_day': "Будь ласка, введіть день свого народження (1-31):",
+        'invalid_birth_day': "Невірний формат дня. Будь ласка, введіть число від 1 до 31.",
+        'ask_birth_month': "Будь ласка, введіть місяць свого народження (1-12):",
+        'invalid_birth_month': "Невірний формат місяця. Будь ласка, введіть число від 1 до 12.",
+        'ask_birth_year': "Будь ласка, введіть рік свого народження (1900-{current_year}):",
+        'invalid_birth_year': "Невірний формат року. Будь ласка, введіть рік від 1900 до {current_year}.",
+        'ask_phone': "Будь ласка, поділіться своїм номером телефону.",
+        'share_phone': "Поділитись",
+        'invalid_phone': "Будь ласка, поділіться своїм номером телефону, натиснувши кнопку.",
+        'location_instruction': "Для участі в марафоні необхідно надати доступ до вашого місцезнаходження.\nБудь ласка, увімкніть геолокацію на своєму пристрої перед тим, як натиснути кнопку «Старт».",
+        'start_button': "СТАРТ",
+        'ask_start': "Коли Ви будете готові розпочати забіг і увімкнете геолокацію, натисніть кнопку Старт.",
+        'retry_start_button': "Повторити СПРОБУ СТАРТ",
+        'retry_start': "Будь ласка, надайте доступ до вашого місцезнаходження, щоб розпочати забіг.\nПеревірте налаштування Telegram та увімкніть геолокацію.",
+        'finish_button': "ФІНІШ",
+        'ask_finish': "Коли завершите забіг, натисніть кнопку «ФІНІШ».\nЩоб записати весь маршрут, увімкніть трансляцію геопозиції: 📎 → Геопозиція → Транслювати геопозицію.",
+        'outside_start_zone': "Ви поза стартовою зоною забігу. Підійдіть до старту і натисніть кнопку ще раз.",
+        'outside_finish_zone': "Ви ще не у фінішній зоні. Коли перетнете фініш, натисніть кнопку «ФІНІШ» ще раз.",
+        'missed_checkpoints': "Ваш маршрут не пройшов через контрольні точки: {missed}. Результат перевірять організатори.",
+        'live_tracking': "Трансляцію геопозиції отримано, ваш маршрут записується. Коли завершите забіг, натисніть кнопку «ФІНІШ».",
+        'finished': "🇺🇦 Ваш забіг завершено! Дякуємо за участь у «Марафоні Героїв»! 🇺🇦",
+        'certificate_title': "СЕРТИФІКАТ УЧАСНИКА",
+        'certificate_event': "«Марафон Героїв»",
+        'certificate_distance': "подолано {distance:.2f} км",
+        'certificate_time': "за {duration}",
+        'certificate_caption': "🏅 Ваш сертифікат учасника «Марафону Героїв»",
+        'website': "Щоб отримати сертифікат про участь у марафоні та нагороди, потрібно зареєструватись на нашому сайті. Для цього натисніть кнопку нижче (для кращої роботи рекомендуємо відкрити у зовнішньому браузері).",
+        'website_button': "Перейти на сайт",
+        'website_url': UKRAINIAN_RUN_URL,
+        'already_registered_button': "Вже зареєструвався",
+        'glory': "🇺🇦🇺🇦 Героям Слава! 🇺🇦🇺🇦",
+        'no_location': "Будь ласка, надайте доступ до вашого місцезнаходження.",
+        'anonymous': "Учасник",
+        'leaderboard_title': "🏆 Найдовші дистанції «Марафону Героїв»:",
+        'leaderboard_line': "{place}. {label} — {distance:.2f} км",
+        'leaderboard_empty': "Поки що немає жодного результату.",
+        'leaderboard_totals': "Учасників: {count}, разом подолано {total:.1f} км.",
+        'leaderboard_buckets': "До 5 км: {0}, 5–10 км: {1}, 10–21 км: {2}, 21–42 км: {3}, понад 42 км: {4}.",
+        'mystats': "Ваша дистанція: {distance:.2f} км.\nМісце: {rank} з {count}.",
+        'mystats_none': "У вас ще немає завершеного забігу. Натисніть /start, щоб узяти участь.",
+    },
+    'en': {
+        'skip': "Skip",
+        'not_provided': "Not provided",
+        'language_selected': "You have selected English.\nPlease enter your name.",
+        'invalid_name': "Please enter a valid name (letters only, minimum 2 characters).",
+        'ask_surname': "Please enter your surname.",
+        'invalid_surname': "Please enter a valid surname (letters only, minimum 2 characters).",
+        'ask_birth_day': "Please enter the day of your birth (1-31):",
+        'invalid_birth_day': "Invalid day format. Please enter a number from 1 to 31.",
+        'ask_birth_month': "Please enter the month of your birth (1-12):",
+        'invalid_birth_month': "Invalid month format. Please enter a number from 1 to 12.",
+        'ask_birth_year': "Please enter the year of your birth (1900-{current_year}):",
+        'invalid_birth_year': "Invalid year format. Please enter a year from 1900 to {current_year}.",
+        'ask_phone': "Please share your phone number.",
+        'share_phone': "Share",
+        'invalid_phone': "Please share your phone number by pressing the button.",
+        'location_instruction': "To participate in the marathon, you need to grant access to your location.\nPlease enable location services on your device before pressing the «Start» button.",
+        'start_button': "START",
+        'ask_start': "When you are ready to start the run and have enabled location services, press the Start button.",
+        'retry_start_button': "Retry START",
+        'retry_start': "Please grant access to your location to start the run.\nCheck your Telegram settings and enable location services.",
+        'finish_button': "FINISH",
+        'ask_finish': "When you finish the run, press the «FINISH» button.\nTo record your whole route, share your live location: 📎 → Location → Share My Live Location.",
+        'outside_start_zone': "You are outside the start area. Please go to the start and press the button again.",
+        'outside_finish_zone': "You are not in the finish area yet. Once you cross the finish, press the «FINISH» button again.",
+        'missed_checkpoints': "Your route did not pass the checkpoints: {missed}. The organizers will review the result.",
+        'live_tracking': "Live location received, your route is being recorded. When you finish the run, press the «FINISH» button.",
+        'finished': "🇺🇦 Your run is finished! Thank you for participating in the «Heroes Marathon»! 🇺🇦",
+        'certificate_title': "CERTIFICATE OF PARTICIPATION",
+        'certificate_event': "«Heroes Marathon»",
+        'certificate_distance': "covered {distance:.2f} km",
+        'certificate_time': "in {duration}",
+        'certificate_caption': "🏅 Your «Heroes Marathon» participation certificate",
+        'website': "To receive a certificate of participation in the marathon and a reward, you need to register on our website. To do this, press the button below (for better performance, we recommend opening in an external browser).",
+        'website_button': "Go to website",
+        'website_url': ENGLISH_RUN_URL,
+        'already_registered_button': "Already registered",
+        'glory': "🇺🇦🇺🇦 Glory to the heroes! 🇺🇦🇺🇦",
+        'no_location': "Please grant access to your location.",
+        'anonymous': "Runner",
+        'leaderboard_title': "🏆 Longest distances of the «Heroes Marathon»:",
+        'leaderboard_line': "{place}. {label} — {distance:.2f} km",
+        'leaderboard_empty': "There are no results yet.",
+        'leaderboard_totals': "Runners: {count}, total distance covered {total:.1f} km.",
+        'leaderboard_buckets': "Under 5 km: {0}, 5–10 km: {1}, 10–21 km: {2}, 21–42 km: {3}, over 42 km: {4}.",
+        'mystats': "Your distance: {distance:.2f} km.\nPlace: {rank} of {count}.",
+        'mystats_none': "You have no finished run yet. Press /start to take part.",
+    },
+}
+
+# Кнопку «Пропустити» приймаємо незалежно від обраної мови
+SKIP_TEXTS = frozenset(texts['skip'] for texts in TEXTS.values())
+NOT_PROVIDED_TEXTS = frozenset(texts['not_provided'] for texts in TEXTS.values())
+
+
+def _build_keyboards(texts):
+    """Будує клавіатури однієї мови і серіалізує їх у JSON, щоб не робити цього на кожне повідомлення."""
+    skip = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    skip.add(types.KeyboardButton(texts['skip']))
+
+    phone = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True, one_time_keyboard=True)
+    phone.add(types.KeyboardButton(text=texts['share_phone'], request_contact=True),
+              types.KeyboardButton(text=texts['skip']))
+
+    start = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True, one_time_keyboard=True)
+    start.add(types.KeyboardButton(text=texts['start_button'], request_location=True))
+
+    retry_start = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+    retry_start.add(types.KeyboardButton(text=texts['retry_start_button'], request_location=True))
+
+    finish = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+    finish.add(types.KeyboardButton(text=texts['finish_button'], request_location=True))
+
+    website = types.InlineKeyboardMarkup()
+    website.add(types.InlineKeyboardButton(text=texts['website_button'], url=texts['website_url']),
+                types.InlineKeyboardButton(text=texts['already_registered_button'], callback_data='already_registered'))
+
+    keyboards = {'skip': skip, 'phone': phone, 'start': start, 'retry_start': retry_start,
+                 'finish': finish, 'website': website}
+    return {name: markup.to_json() for name, markup in keyboards.items()}
+
+
+_language_keyboard = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+_language_keyboard.add(*(types.KeyboardButton(label) for label in LANGUAGES))
+LANGUAGE_KEYBOARD = _language_keyboard.to_json()
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove().to_json()
+
+# telebot передає рядок reply_markup у Bot API як є, тож готовий JSON не серіалізується повторно
+KEYBOARDS = {language: _build_keyboards(texts) for language, texts in TEXTS.items()}
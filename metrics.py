@@ -0,0 +1,214 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Ендпоінт лише локальний: його читає Prometheus-агент на тій самій машині. 0 вимикає сервер.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+SLOW_HANDLER_SECONDS = float(os.environ.get('SLOW_HANDLER_SECONDS', 1))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Лічильник, що лише зростає; значення міток передаються позиційно."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """Показник, що читається функцією в момент збору, наприклад довжина черги."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._functions = {}
+
+    def track(self, *label_values, func):
+        with self._lock:
+            self._functions[label_values] = func
+
+    def _samples(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        samples = []
+        for key, func in functions:
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"Не вдалося прочитати {self.name}{key}: {e}")
+                continue
+            samples.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return samples
+
+
+class Histogram(_Metric):
+    """Гістограма тривалостей у секундах з накопичувальними кошиками Prometheus."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # значення міток -> [кількість у кожному кошику + inf, сума]
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def _samples(self):
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                samples.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', le)])} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+HANDLER_SECONDS = Histogram('marathon_handler_seconds', "Час обробки оновлення", ('handler', 'step'))
+REGISTRATIONS = Counter('marathon_registrations_total',
+                        "Реєстрації: started — /start, completed — фініш, abandoned — повторний /start до фінішу "
+                        "або сесія, що зникла за TTL до фінішу",
+                        ('stage',))
+DB_SECONDS = Histogram('marathon_db_seconds', "Тривалість операцій PostgreSQL разом із повторами", ('operation',))
+DB_POOL_WAIT_SECONDS = Histogram('marathon_db_pool_wait_seconds', "Очікування вільного з'єднання в пулі")
+TELEGRAM_SECONDS = Histogram('marathon_telegram_seconds', "Тривалість викликів Bot API", ('method',))
+TELEGRAM_ERRORS = Counter('marathon_telegram_errors_total', "Невдалі виклики Bot API", ('method', 'code'))
+QUEUE_DEPTH = Gauge('marathon_queue_depth', "Кількість елементів у внутрішніх чергах", ('queue',))
+
+
+def timed(handler, step=''):
+    """Декоратор обробника: пише тривалість у HANDLER_SECONDS і журналює повільні виклики."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe_handler(handler, step, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_handler(handler, step, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def observe_handler(handler, step, elapsed, chat_id=None):
+    HANDLER_SECONDS.observe(elapsed, handler, step or '')
+    if elapsed >= SLOW_HANDLER_SECONDS:
+        logger.warning(f"Повільний обробник {handler} (крок {step or '-'}, чат {chat_id}): {elapsed:.3f} с")
+
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускає /metrics у фоновому потоці; повертає сервер або None, якщо його вимкнено."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,175 @@
+"""Версійовані міграції схеми PostgreSQL; бот виконує migrate() під час запуску.
+
+Кожна міграція виконується в окремій транзакції та записується у schema_migrations.
+Рекомендаційне блокування не дає кільком процесам бота мігрувати одночасно.
+"""
+import logging
+
+import db
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_LOCK = 0x6d617261  # довільний ключ pg_advisory_lock для міграцій цього бота
+
+RESULT_COLUMN_TYPES = """
+    name TEXT,
+    surname TEXT,
+    birthdate TEXT,
+    phone_number TEXT,
+    start_time TIMESTAMP,
+    start_latitude DOUBLE PRECISION,
+    start_longitude DOUBLE PRECISION,
+    finish_time TIMESTAMP,
+    finish_latitude DOUBLE PRECISION,
+    finish_longitude DOUBLE PRECISION,
+    distance_km DOUBLE PRECISION,
+    track_polyline TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+"""
+
+
+def _table_kind(cur, table):
+    """relkind таблиці ('r' — звичайна, 'p' — секціонована) або None, якщо її немає."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _legacy_columns(cur):
+    # Старій таблиці marathon_results, створеній поза репозиторієм: колонки track_polyline і updated_at
+    # (для інкрементального експорту) та таблиця курсорів export_cursors
+    if _table_kind(cur, 'marathon_results') == 'r':
+        cur.execute("ALTER TABLE marathon_results ADD COLUMN IF NOT EXISTS track_polyline TEXT")
+        cur.execute("ALTER TABLE marathon_results ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS export_cursors (
+            name TEXT PRIMARY KEY,
+            exported_until TIMESTAMP NOT NULL
+        )
+    """)
+
+
+def _events(cur):
+    cur.execute("""
+        CREATE TABLE events (
+            id SERIAL PRIMARY KEY,
+            slug TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            starts_on DATE NOT NULL,
+            ends_on DATE NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """)
+    legacy = _table_kind(cur, 'marathon_results') == 'r'
+    if legacy:
+        # Старі індекси звільняють імена для індексів нової таблиці
+        cur.execute("ALTER TABLE marathon_results RENAME TO marathon_results_legacy")
+        for index in ('marathon_results_pkey', 'marathon_results_distance_idx', 'marathon_results_updated_at_idx'):
+            cur.execute(f"ALTER INDEX IF EXISTS {index} RENAME TO {index.replace('marathon_results', 'marathon_results_legacy')}")
+    cur.execute(f"""
+        CREATE TABLE marathon_results (
+            event_id INTEGER NOT NULL REFERENCES events (id),
+            chat_id BIGINT NOT NULL,
+            attempt SMALLINT NOT NULL DEFAULT 1,
+            {RESULT_COLUMN_TYPES},
+            PRIMARY KEY (event_id, chat_id, attempt)
+        ) PARTITION BY LIST (event_id)
+    """)
+    # Індекси секціонованої таблиці створюються в кожній секції; запити з event_id читають лише одну
+    cur.execute("CREATE INDEX marathon_results_distance_idx ON marathon_results (event_id, distance_km DESC)")
+    cur.execute("CREATE INDEX marathon_results_updated_at_idx ON marathon_results (updated_at)")
+
+    # Перевірки правдоподібності похідні від результатів, manage.py validate перераховує їх заново
+    cur.execute("DROP TABLE IF EXISTS result_validations")
+    cur.execute("""
+        CREATE TABLE result_validations (
+            event_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            attempt SMALLINT NOT NULL,
+            distance_km DOUBLE PRECISION,
+            avg_speed_kmh DOUBLE PRECISION,
+            pace_min_per_km DOUBLE PRECISION,
+            max_track_speed_kmh DOUBLE PRECISION,
+            flags INTEGER NOT NULL,
+            validated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (event_id, chat_id, attempt)
+        )
+    """)
+
+    if legacy:
+        # Результати, записані до підтримки кількох марафонів, стають окремою подією 'legacy'
+        cur.execute("""
+            INSERT INTO events (slug, title, starts_on, ends_on)
+            SELECT 'legacy', 'Марафон Героїв (до підтримки кількох марафонів)',
+                   coalesce(min(NULLIF(start_time::text, '')::timestamp::date), current_date),
+                   coalesce(max(NULLIF(start_time::text, '')::timestamp::date), current_date)
+            FROM marathon_results_legacy
+            RETURNING id
+        """)
+        event_id = cur.fetchone()[0]
+        create_partition(cur, event_id)
+        cur.execute(f"""
+            INSERT INTO marathon_results (event_id, chat_id, attempt, {', '.join(db.RESULT_COLUMNS[3:])}, updated_at)
+            SELECT %s, chat_id, 1, name, surname, birthdate, phone_number,
+                   NULLIF(start_time::text, '')::timestamp, start_latitude, start_longitude,
+                   NULLIF(finish_time::text, '')::timestamp, finish_latitude, finish_longitude,
+                   distance_km, track_polyline, updated_at
+            FROM marathon_results_legacy
+        """, (event_id,))
+        logger.warning(f"Перенесено {cur.rowcount} результатів у подію legacy; "
+                       "стара таблиця лишилася як marathon_results_legacy")
+
+
+# (версія, опис, функція(cursor)); нові міграції лише додаються в кінець
+MIGRATIONS = (
+    (1, "track_polyline і updated_at у marathon_results, таблиця export_cursors", _legacy_columns),
+    (2, "таблиця events і marathon_results, секціонована за подією", _events),
+)
+
+
+def partition_name(event_id):
+    return f"marathon_results_e{int(event_id)}"
+
+
+def partition_ddl(event_id):
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(event_id)} "
+            f"PARTITION OF marathon_results FOR VALUES IN ({int(event_id)})")
+
+
+def create_partition(cur, event_id):
+    cur.execute(partition_ddl(event_id))
+
+
+def migrate(pool):
+    """Застосовує міграції, яких ще немає у schema_migrations."""
+    def migrate_schema(pooled):
+        with pooled.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK,))
+            try:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP NOT NULL DEFAULT now()
+                    )
+                """)
+                cur.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cur.fetchall()}
+                for version, description, apply in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    logger.warning(f"Міграція схеми {version}: {description}")
+                    # З'єднання пулу в autocommit, тож транзакцію відкриваємо явно
+                    cur.execute("BEGIN")
+                    try:
+                        apply(cur)
+                        cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                                    (version, description))
+                        cur.execute("COMMIT")
+                    except Exception:
+                        cur.execute("ROLLBACK")
+                        raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK,))
+
+    db.run_with_retry(pool, migrate_schema)
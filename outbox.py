@@ -0,0 +1,361 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ліміти Bot API: близько 30 повідомлень на секунду загалом і 1 на секунду в один чат
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = float(os.environ.get('OUTBOX_CHAT_BURST', 3))  # відповідь на крок — до трьох повідомлень поспіль
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', 8))
+OUTBOX_ASYNC_SENDERS = int(os.environ.get('OUTBOX_ASYNC_SENDERS', 50))  # одночасних запитів AsyncOutbox
+OUTBOX_MAX_RETRIES = int(os.environ.get('OUTBOX_MAX_RETRIES', 5))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class TokenBucket:
+    """Відро токенів: rate токенів на секунду, не більше capacity в запасі."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Скільки секунд чекати до наступного токена (0 — можна надсилати зараз)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block_until(self, until):
+        """Після 429 нічого не надсилаємо до until."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - (until - now) * self.rate)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing:
+    __slots__ = ('method', 'args', 'kwargs', 'priority', 'future', 'attempts')
+
+    def __init__(self, method, args, kwargs, priority, future=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future() if future is None else future
+        self.attempts = 0
+
+
+class _OutboxState:
+    """Стан черги, спільний для Outbox і AsyncOutbox: черги чатів, пріоритети, відра токенів і пауза після 429.
+
+    Методи нічого не чекають: Outbox викликає їх під своїм Condition, AsyncOutbox — з потоку циклу подій.
+    """
+
+    def __init__(self, bot, global_rate, chat_rate, chat_burst, api_error):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._api_error = api_error
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._pending = {}      # chat_id -> deque[_Outgoing]
+        self._inflight = set()
+        self._runnable = []     # (priority, seq, chat_id)
+        self._delayed = []      # (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._size = 0
+        self._next_prune = time.monotonic() + 60
+
+    def send_message(self, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        return self.submit(chat_id, 'send_message', text, priority=priority, **kwargs)
+
+    def backlog(self):
+        """Кількість викликів, що ще не надіслано (разом із тими, що зараз у дорозі)."""
+        return self._size
+
+    def _enqueue(self, chat_id, item):
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+        queue.append(item)
+        self._size += 1
+        if len(queue) == 1 and chat_id not in self._inflight:
+            self._schedule(chat_id, time.monotonic())
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _block(self, chat_id, until):
+        # 429 не каже, чи це ліміт чату, чи всього бота. Ліміт чату вже тримає відро чату,
+        # тож паузу отримують і всі інші чати, щоб кожен не витратив на свій 429 ще одну спробу
+        self._bucket(chat_id).block_until(until)
+        self._global.block_until(until)
+
+    def _schedule(self, chat_id, now):
+        # Викликається, коли чат має що надіслати і нічого не в дорозі
+        delay = self._bucket(chat_id).delay(now)
+        if delay:
+            heapq.heappush(self._delayed, (now + delay, next(self._seq), chat_id))
+        else:
+            heapq.heappush(self._runnable, (self._pending[chat_id][0].priority, next(self._seq), chat_id))
+
+    def _ready_chat(self, now):
+        """Чат, чия черга може надсилати зараз (позначається як у дорозі), або None і скільки чекати (None — до submit)."""
+        if now >= self._next_prune:
+            self._prune(now)
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._delayed)
+            heapq.heappush(self._runnable, (self._pending[chat_id][0].priority, next(self._seq), chat_id))
+        if self._runnable:
+            _, _, chat_id = heapq.heappop(self._runnable)
+            self._inflight.add(chat_id)
+            return chat_id, None
+        return None, self._delayed[0][0] - now if self._delayed else None
+
+    def _prune(self, now):
+        # Відра неактивних чатів, що вже наповнилися, нічим не відрізняються від нових
+        idle = [chat_id for chat_id, bucket in self._buckets.items()
+                if chat_id not in self._pending and chat_id not in self._inflight and bucket.is_full(now)]
+        for chat_id in idle:
+            del self._buckets[chat_id]
+        self._next_prune = now + 60
+
+    def _take(self, chat_id):
+        """Бере токени бота й чату і наступний виклик чату; відро бота має бути вже вільним."""
+        now = time.monotonic()
+        self._global.take(now)
+        self._bucket(chat_id).take(now)
+        return self._pending[chat_id].popleft()
+
+    def _call(self, item):
+        item.attempts += 1
+        if callable(item.method):
+            return item.method, item.method.__name__
+        return getattr(self.bot, item.method), item.method
+
+    def _settle(self, chat_id, item, name, elapsed, result=None, error=None):
+        """Записує метрики й результат виклику; повертає паузу в секундах, якщо виклик треба повторити після 429."""
+        metrics.TELEGRAM_SECONDS.observe(elapsed, name)
+        if error is None:
+            if not item.future.done():
+                item.future.set_result(result)
+            return None
+        if isinstance(error, self._api_error):
+            metrics.TELEGRAM_ERRORS.inc(name, error.error_code)
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after')
+            if error.error_code == 429 and retry_after and item.attempts <= OUTBOX_MAX_RETRIES:
+                logger.warning(f"Telegram 429 для чату {chat_id}, повтор через {retry_after} с")
+                return retry_after
+        else:
+            metrics.TELEGRAM_ERRORS.inc(name, 'network')
+        logger.error(f"Не вдалося виконати {name} для чату {chat_id}: {error}")
+        if not item.future.done():
+            item.future.set_exception(error)
+        return None
+
+    def _finish(self, chat_id, item, retry_after=None):
+        now = time.monotonic()
+        self._inflight.discard(chat_id)
+        queue = self._pending[chat_id]
+        if retry_after:
+            # Повертаємо на початок черги чату, щоб не порушити порядок повідомлень
+            queue.appendleft(item)
+            self._block(chat_id, now + retry_after)
+        else:
+            self._size -= 1
+        if queue:
+            self._schedule(chat_id, now)
+        else:
+            del self._pending[chat_id]
+
+
+class Outbox(_OutboxState):
+    """Черга вихідних викликів Bot API з лімітами на бот і на чат, пріоритетами та повтором після 429.
+
+    Повідомлення одного чату надсилаються строго по черзі; інтерактивні відповіді обганяють масові розсилки.
+    """
+
+    def __init__(self, bot, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, senders=OUTBOX_SENDERS):
+        super().__init__(bot, global_rate, chat_rate, chat_burst, ApiTelegramException)
+        self._closed = False
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='outbox-sender')
+        self._thread = threading.Thread(target=self._dispatch, name='outbox', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, chat_id, method, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Ставить виклик bot.<method>(chat_id, *args, **kwargs) у чергу; повертає Future з результатом.
+
+        method — ім'я методу бота або функція з тими самими аргументами (наприклад, щоб відкривати файл
+        заново на кожну спробу).
+        """
+        item = _Outgoing(method, (chat_id,) + args, kwargs, priority)
+        with self._cond:
+            self._enqueue(chat_id, item)
+            self._cond.notify()
+        return item.future
+
+    def close(self, timeout=10):
+        """Зупиняє диспетчер після того, як черга спорожніє або мине timeout секунд."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._size and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._senders.shutdown(wait=False)
+
+    def _next_chat(self):
+        with self._cond:
+            while not self._closed:
+                chat_id, wait = self._ready_chat(time.monotonic())
+                if chat_id is not None:
+                    return chat_id
+                self._cond.wait(wait)
+            return None
+
+    def _dispatch(self):
+        while True:
+            chat_id = self._next_chat()
+            if chat_id is None:
+                return
+            while True:
+                # Наново після сну: тим часом 429 міг заблокувати відро бота
+                with self._cond:
+                    delay = self._global.delay(time.monotonic())
+                if not delay:
+                    break
+                time.sleep(delay)
+            with self._cond:
+                item = self._take(chat_id)
+            self._senders.submit(self._send, chat_id, item)
+
+    def _send(self, chat_id, item):
+        call, name = self._call(item)
+        started = time.perf_counter()
+        try:
+            result = call(*item.args, **item.kwargs)
+        except Exception as e:
+            retry_after = self._settle(chat_id, item, name, time.perf_counter() - started, error=e)
+        else:
+            retry_after = self._settle(chat_id, item, name, time.perf_counter() - started, result)
+        with self._cond:
+            self._finish(chat_id, item, retry_after)
+            self._cond.notify_all()
+
+
+class AsyncOutbox(_OutboxState):
+    """Outbox для AsyncTeleBot: ті самі ліміти, пріоритети, порядок у чаті й повтор після 429.
+
+    Диспетчер — одна корутина, кожен виклик Bot API — окрема задача asyncio; senders обмежує, скільки
+    запитів одночасно в дорозі. Усі методи викликаються з потоку циклу подій, тож блокування не потрібні.
+    """
+
+    def __init__(self, bot, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, senders=OUTBOX_ASYNC_SENDERS):
+        from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+        super().__init__(bot, global_rate, chat_rate, chat_burst, AsyncApiTelegramException)
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._senders = asyncio.Semaphore(senders)
+        self._tasks = set()
+        self._dispatcher = None
+
+    def start(self):
+        self._dispatcher = asyncio.create_task(self._dispatch(), name='outbox')
+        return self
+
+    def submit(self, chat_id, method, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Ставить виклик у чергу й одразу повертає asyncio.Future; method — ім'я методу бота або корутинна функція."""
+        item = _Outgoing(method, (chat_id,) + args, kwargs, priority, asyncio.get_running_loop().create_future())
+        self._enqueue(chat_id, item)
+        self._drained.clear()
+        self._wakeup.set()
+        return item.future
+
+    async def close(self, timeout=10):
+        """Чекає, поки черга спорожніє (не довше timeout секунд), і зупиняє диспетчер."""
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox зупинено з {self._size} ненадісланими викликами")
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *filter(None, [self._dispatcher]), return_exceptions=True)
+
+    async def _next_chat(self):
+        while True:
+            chat_id, wait = self._ready_chat(time.monotonic())
+            if chat_id is not None:
+                return chat_id
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self):
+        while True:
+            chat_id = await self._next_chat()
+            await self._senders.acquire()
+            # Наново після сну: тим часом 429 міг заблокувати відро бота
+            while delay := self._global.delay(time.monotonic()):
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(self._send(chat_id, self._take(chat_id)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, chat_id, item):
+        call, name = self._call(item)
+        started = time.perf_counter()
+        try:
+            result = await call(*item.args, **item.kwargs)
+        except Exception as e:
+            retry_after = self._settle(chat_id, item, name, time.perf_counter() - started, error=e)
+        else:
+            retry_after = self._settle(chat_id, item, name, time.perf_counter() - started, result)
+        finally:
+            self._senders.release()
+        self._finish(chat_id, item, retry_after)
+        if not self._size:
+            self._drained.set()
+        self._wakeup.set()
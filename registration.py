@@ -0,0 +1,53 @@
+from collections import namedtuple
+from datetime import datetime
+
+# prompts — ключі текстів у messages.TEXTS (клавіатура додається до останнього),
+# field — поле RunnerState, validate(message) повертає значення або None, error — текст помилки.
+# Кроки без field (старт, фініш) обробляються окремими функціями бота.
+Step = namedtuple('Step', ['prompts', 'keyboard', 'field', 'validate', 'error', 'next'])
+
+
+def _letters(message):
+    text = message.text or ''
+    return text if text.isalpha() and len(text) >= 2 else None
+
+
+def _number(low, high):
+    def validate(message):
+        text = message.text or ''
+        return text.zfill(2) if text.isdigit() and low <= int(text) <= high else None
+    return validate
+
+
+def _birth_year(message):
+    text = message.text or ''
+    return text if text.isdigit() and 1900 <= int(text) <= datetime.now().year else None
+
+
+def _contact(message):
+    return message.contact.phone_number if message.contact else None
+
+
+STEPS = {
+    'name': Step(('language_selected',), 'skip', 'name', _letters, 'invalid_name', 'surname'),
+    'surname': Step(('ask_surname',), 'skip', 'surname', _letters, 'invalid_surname', 'birth_day'),
+    'birth_day': Step(('ask_birth_day',), 'skip', 'birth_day', _number(1, 31), 'invalid_birth_day', 'birth_month'),
+    'birth_month': Step(('ask_birth_month',), 'skip', 'birth_month', _number(1, 12), 'invalid_birth_month', 'birth_year'),
+    'birth_year': Step(('ask_birth_year',), 'skip', 'birth_year', _birth_year, 'invalid_birth_year', 'phone'),
+    'phone': Step(('ask_phone',), 'phone', 'phone_number', _contact, 'invalid_phone', 'start'),
+    'start': Step(('location_instruction', 'ask_start'), 'start', None, None, None, 'finish'),
+    'start_retry': Step(('retry_start',), 'retry_start', None, None, None, 'finish'),
+    'finish': Step(('ask_finish',), 'finish', None, None, None, None),
+    # Геопозиція поза зоною старту чи фінішу траси (course.py) — учасник надсилає її ще раз
+    'start_outside': Step(('outside_start_zone',), 'retry_start', None, None, None, 'finish'),
+    'finish_outside': Step(('outside_finish_zone',), 'finish', None, None, None, None),
+}
+FIELD_STEPS = frozenset(name for name, step in STEPS.items() if step.field)
+
+
+def complete_field(state, step_name, not_provided):
+    """Дії після заповнення поля; дата народження складається, навіть якщо щось пропущено."""
+    state.registration_step = f'{step_name}_received'
+    if step_name == 'birth_year':
+        state.birthdate = "/".join(
+            getattr(state, field) or not_provided for field in ('birth_day', 'birth_month', 'birth_year'))
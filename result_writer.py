@@ -0,0 +1,304 @@
+import asyncio
+import csv
+import fcntl
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+import aiodb
+import db
+import events
+
+logger = logging.getLogger(__name__)
+
+WRITER_BATCH_SIZE = int(os.environ.get('WRITER_BATCH_SIZE', 200))
+WRITER_FLUSH_INTERVAL = float(os.environ.get('WRITER_FLUSH_INTERVAL', 1))  # seconds
+WRITER_RETRY_INTERVAL = float(os.environ.get('WRITER_RETRY_INTERVAL', 10))  # seconds
+
+# Колонки, які при читанні спулу потрібно повернути з тексту у числа або NULL
+_INT_COLUMNS = {'event_id', 'chat_id', 'attempt'}
+_FLOAT_COLUMNS = {'start_latitude', 'start_longitude', 'finish_latitude', 'finish_longitude', 'distance_km'}
+_NULLABLE_COLUMNS = {'start_time', 'finish_time', 'track_polyline'}
+
+# Помилки, після яких PostgreSQL вважається недоступною і рядки чекають у спулі; решту помилок дає сам рядок
+_UNAVAILABLE = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+_STOP = object()
+
+
+def _encode(row):
+    return ['' if value is None else value for value in row]
+
+
+def _decode(header, record):
+    # Спул, записаний до появи подій, не має event_id і attempt: подію підставляє resolve_event,
+    # спробу — events.resolve_attempts, як і для рядків, записаних без неї
+    values = dict(zip(header, record))
+    row = []
+    for column in db.RESULT_COLUMNS:
+        value = values.get(column, '')
+        if column in _INT_COLUMNS:
+            value = int(value) if value else None
+        elif column in _FLOAT_COLUMNS:
+            value = float(value) if value else None
+        elif column in _NULLABLE_COLUMNS:
+            value = value or None
+        row.append(value)
+    return tuple(row)
+
+
+def _spool_exists(path):
+    try:
+        return os.path.getsize(path) > 0
+    except OSError:
+        return False
+
+
+@contextmanager
+def _spool_lock(path, blocking=True):
+    """Блокування спулу між процесами, що пишуть в один файл; без blocking повертає False, якщо воно зайняте."""
+    with open(path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _append_spool(path, rows):
+    # Чекає, поки інший процес перенесе спул, інакше його truncate стер би щойно дописані рядки
+    with _spool_lock(path):
+        new_file = not _spool_exists(path)
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(db.RESULT_COLUMNS)
+            writer.writerows(_encode(row) for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _read_spool(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, db.RESULT_COLUMNS)
+        return [_decode(header, record) for record in reader if record]
+
+
+def coalesce(rows):
+    """Залишає для кожної спроби (event_id, chat_id, attempt) лише останній результат, зберігаючи порядок надходження."""
+    key_size = len(db.KEY_COLUMNS)
+    latest = {}
+    for row in rows:
+        key = row[:key_size]
+        latest.pop(key, None)
+        latest[key] = row
+    return list(latest.values())
+
+
+def _rejected_path(spool_path):
+    root, ext = os.path.splitext(spool_path)
+    return f"{root}.rejected{ext or '.csv'}"
+
+
+class ResultWriter:
+    """Фоновий запис результатів у PostgreSQL пачками з локальним спулом на час недоступності БД.
+
+    resolve_event() повертає id поточної події для рядків, у яких її не вдалося визначити під час фінішу.
+    Рядки, які PostgreSQL відхиляє, дописуються у rejected_path (типово marathon_results.rejected.csv
+    поруч зі спулом) і не затримують решту.
+    """
+
+    def __init__(self, pool, spool_path, batch_size=WRITER_BATCH_SIZE,
+                 flush_interval=WRITER_FLUSH_INTERVAL, retry_interval=WRITER_RETRY_INTERVAL, resolve_event=None,
+                 rejected_path=None):
+        self.pool = pool
+        self.spool_path = spool_path
+        self.rejected_path = rejected_path or _rejected_path(spool_path)
+        self.resolve_event = resolve_event
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self._queue = queue.Queue()
+        self._next_retry = 0.0
+        self._thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, row):
+        """Ставить рядок у чергу на запис; ніколи не блокує обробник повідомлень."""
+        self._queue.put(row)
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=None):
+        """Дописує все, що лишилося в черзі, і зупиняє фоновий потік."""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _collect(self):
+        """Чекає першого рядка, потім добирає пачку до batch_size або до кінця flush_interval."""
+        try:
+            item = self._queue.get(timeout=self.retry_interval)
+        except queue.Empty:
+            return [], False
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if stopping:
+                # Забираємо все, що встигло надійти до сигналу зупинки
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+            try:
+                self._flush(batch)
+            except Exception:
+                logger.exception("Збій фонового запису результатів, пачку записано у спул")
+                _append_spool(self.spool_path, batch)
+
+    def _flush(self, batch):
+        # Поки спул не порожній, нові рядки пишуться після нього, щоб не обігнати старіші
+        if _spool_exists(self.spool_path) and not self._replay_spool():
+            if batch:
+                _append_spool(self.spool_path, batch)
+            return
+        if not batch:
+            return
+        rows = self._with_event(batch)
+        error = self._save(rows)
+        if error is not None:
+            logger.error(f"PostgreSQL недоступна, {len(rows)} результатів записано у спул {self.spool_path}: {error}")
+            self._next_retry = time.monotonic() + self.retry_interval
+            _append_spool(self.spool_path, rows)
+
+    def _save_results(self, rows):
+        db.save_results(self.pool, rows)
+
+    def _resolve_attempts(self, rows):
+        return events.resolve_attempts(self.pool, rows)
+
+    def _current_event(self):
+        return self.resolve_event()
+
+    def _save(self, rows):
+        """Пише рядки пачками; повертає помилку, якщо PostgreSQL недоступна, і None, якщо все записано або відхилено."""
+        if any(row[0] is None for row in rows):
+            return "поточна подія невідома"
+        # Спробу підставляємо до coalesce: два різні забіги без неї мають однаковий ключ
+        try:
+            rows = coalesce(self._resolve_attempts(rows))
+        except _UNAVAILABLE as e:
+            return e
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i:i + self.batch_size]
+            try:
+                self._save_results(chunk)
+            except _UNAVAILABLE as e:
+                return e
+            except psycopg2.Error as e:
+                # Пачку відхилив якийсь її рядок: записуємо по одному, щоб знайти його і зберегти решту
+                logger.warning(f"PostgreSQL відхилила пачку з {len(chunk)} результатів, запис по одному: {e}")
+                rejected = []
+                for row in chunk:
+                    try:
+                        self._save_results([row])
+                    except _UNAVAILABLE as e:
+                        return e
+                    except psycopg2.Error as e:
+                        logger.error(f"PostgreSQL відхилила результат {row[:len(db.KEY_COLUMNS)]}, "
+                                     f"його записано у {self.rejected_path}: {e}")
+                        rejected.append(row)
+                if rejected:
+                    _append_spool(self.rejected_path, rejected)
+        return None
+
+    def _with_event(self, rows):
+        rows = list(rows)
+        if self.resolve_event is None or all(row[0] is not None for row in rows):
+            return rows
+        event_id = self._current_event()
+        return [(event_id,) + row[1:] if row[0] is None else row for row in rows]
+
+    def _replay_spool(self):
+        """Переносить спул у PostgreSQL; повертає True, якщо спул порожній після спроби."""
+        if time.monotonic() < self._next_retry:
+            return False
+        # Блокування тримається від читання до truncate: інші процеси тим часом не допишуть у спул рядків,
+        # які truncate стер би, не перенісши
+        with _spool_lock(self.spool_path, blocking=False) as locked:
+            if not locked:
+                # Спул переносить інший процес; нові рядки підуть у спул після нього
+                return False
+            if not _spool_exists(self.spool_path):
+                return True
+            rows = self._with_event(_read_spool(self.spool_path))
+            error = self._save(rows)
+            if error is not None:
+                logger.error(f"Не вдалося перенести спул {self.spool_path} у PostgreSQL: {error}")
+                self._next_retry = time.monotonic() + self.retry_interval
+                return False
+            os.truncate(self.spool_path, 0)
+        logger.warning(f"Спул {self.spool_path} перенесено у PostgreSQL: {len(rows)} результатів")
+        return True
+
+
+class AsyncResultWriter(ResultWriter):
+    """ResultWriter для асинхронного бота: той самий потік запису й спул, запити — через aiodb у циклі подій.
+
+    Потік запису передає корутини aiodb у цикл подій, з якого викликано start(), і чекає на них, тож обробники
+    не чекають ні на БД, ні на fsync спулу. resolve_event — корутинна функція, що повертає id поточної події.
+    """
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        return super().start()
+
+    async def close(self, timeout=None):
+        """Дописує все, що лишилося в черзі, і зупиняє потік запису, не зупиняючи цикл подій."""
+        await asyncio.to_thread(super().close, timeout)
+
+    def _in_loop(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _save_results(self, rows):
+        self._in_loop(aiodb.save_results(self.pool, rows))
+
+    def _resolve_attempts(self, rows):
+        return self._in_loop(events.resolve_attempts_async(self.pool, rows))
+
+    def _current_event(self):
+        return self._in_loop(self.resolve_event())
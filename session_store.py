@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL', 'memory://')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 3600))  # seconds
+REGISTRATION_TTL = int(os.environ.get('REGISTRATION_TTL', 2 * 3600))  # seconds
+# Як часто сховище видаляє прострочені сесії і рахує покинуті реєстрації
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 60))  # seconds
+
+
+class RunnerState:
+    """Стан учасника в одному чаті: дані реєстрації, забігу та поточний крок розмови."""
+
+    __slots__ = (
+        'chat_id', 'step', 'language', 'name', 'surname',
+        'birth_day', 'birth_month', 'birth_year', 'birthdate',
+        'phone_number', 'registration_step',
+        'start_location', 'start_time', 'finish_location', 'finish_time', 'distance',
+        'track', 'event_id', 'attempt',
+    )
+    _LOCATIONS = ('start_location', 'finish_location')
+
+    def __init__(self, chat_id, **fields):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.chat_id = chat_id
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def ttl(self):
+        # Незавершена реєстрація живе недовго, розпочатий забіг — до кінця марафону
+        return SESSION_TTL if self.start_time else REGISTRATION_TTL
+
+    def dumps(self):
+        """Компактна серіалізація: JSON-масив значень у порядку __slots__."""
+        return json.dumps([getattr(self, slot) for slot in self.__slots__],
+                          ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, payload):
+        state = cls.__new__(cls)
+        # Записи, збережені до появи нових полів, коротші за __slots__
+        for slot in cls.__slots__:
+            setattr(state, slot, None)
+        for slot, value in zip(cls.__slots__, json.loads(payload)):
+            if slot in cls._LOCATIONS and value is not None:
+                value = tuple(value)
+            setattr(state, slot, value)
+        return state
+
+    def __repr__(self):
+        return f"RunnerState(chat_id={self.chat_id!r}, step={self.step!r})"
+
+
+def _count_abandoned(states):
+    # Сесія, що зникла за TTL посеред реєстрації чи забігу, — покинута; після фінішу крок уже None
+    abandoned = sum(1 for state in states if state.step is not None)
+    if abandoned:
+        metrics.REGISTRATIONS.inc('abandoned', amount=abandoned)
+
+
+class MemorySessionStore:
+    """Сховище в пам'яті процесу; підходить лише для одного воркера."""
+
+    blocking = False
+    # Стани зникають разом із процесом; після перезапуску їх повертає журнал
+    local = True
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+
+    def load(self, chat_id):
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._sessions[chat_id]
+                _count_abandoned([entry[0]])
+                return None
+            return entry[0]
+
+    def save(self, state):
+        now = time.monotonic()
+        with self._lock:
+            previous = self._sessions.get(state.chat_id)
+            if previous is not None and previous[1] < now:
+                _count_abandoned([previous[0]])
+            self._sessions[state.chat_id] = (state, now + state.ttl())
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+    def _sweep(self, now):
+        expired = [chat_id for chat_id, (_, expires_at) in self._sessions.items() if expires_at < now]
+        _count_abandoned([self._sessions.pop(chat_id)[0] for chat_id in expired])
+        self._next_sweep = now + SESSION_SWEEP_INTERVAL
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """Спільне сховище у файлі SQLite для кількох воркерів на одній машині та для тестів."""
+
+    blocking = True
+    local = False
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        conn.commit()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def load(self, chat_id):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE chat_id = ? AND expires_at >= ?", (chat_id, time.time())
+        ).fetchone()
+        return RunnerState.loads(row[0]) if row else None
+
+    def save(self, state):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            # Прострочену сесію, яку ще не прибрав sweep, враховуємо як покинуту перед перезаписом
+            expired = conn.execute(
+                "DELETE FROM sessions WHERE chat_id = ? AND expires_at < ? RETURNING data", (state.chat_id, now)
+            ).fetchall()
+            conn.execute(
+                "INSERT INTO sessions (chat_id, data, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (chat_id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (state.chat_id, state.dumps(), now + state.ttl()),
+            )
+        _count_abandoned(RunnerState.loads(row[0]) for row in expired)
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+            self.sweep()
+
+    def delete(self, chat_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def sweep(self):
+        """Видаляє прострочені сесії; кожен воркер викликає це не частіше ніж раз на SESSION_SWEEP_INTERVAL."""
+        conn = self._connection()
+        with conn:
+            expired = conn.execute("DELETE FROM sessions WHERE expires_at < ? RETURNING data", (time.time(),)).fetchall()
+        _count_abandoned(RunnerState.loads(row[0]) for row in expired)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisSessionStore:
+    """Спільне сховище в Redis (або сумісному сервері) для кількох воркерів; TTL виконує сам сервер.
+
+    Сервер видаляє ключі мовчки, тож незавершені сесії додатково лежать у sorted set <prefix>open
+    з часом закінчення: з нього sweep рахує покинуті реєстрації.
+    """
+
+    blocking = True
+    local = False
+
+    def __init__(self, url, prefix='marathon:session:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._open = f"{prefix}open"
+        self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+
+    def load(self, chat_id):
+        payload = self._redis.get(f"{self.prefix}{chat_id}")
+        return RunnerState.loads(payload) if payload else None
+
+    def save(self, state):
+        now = time.time()
+        # MULTI/EXEC: sweep не прибере старий запис між ZSCORE і ZADD, тож покинута сесія рахується один раз
+        with self._redis.pipeline() as pipe:
+            pipe.zscore(self._open, state.chat_id)
+            pipe.set(f"{self.prefix}{state.chat_id}", state.dumps(), ex=state.ttl())
+            if state.step is not None:
+                pipe.zadd(self._open, {state.chat_id: now + state.ttl()})
+            else:
+                pipe.zrem(self._open, state.chat_id)
+            expires_at = pipe.execute()[0]
+        if expires_at is not None and expires_at < now:
+            metrics.REGISTRATIONS.inc('abandoned')
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+            self.sweep()
+
+    def delete(self, chat_id):
+        with self._redis.pipeline() as pipe:
+            pipe.delete(f"{self.prefix}{chat_id}")
+            pipe.zrem(self._open, chat_id)
+            pipe.execute()
+
+    def sweep(self):
+        """Рахує покинутими незавершені сесії, чий TTL минув; ZREMRANGEBYSCORE атомарний для кількох воркерів."""
+        abandoned = self._redis.zremrangebyscore(self._open, '-inf', time.time())
+        if abandoned:
+            metrics.REGISTRATIONS.inc('abandoned', amount=abandoned)
+
+    def close(self):
+        self._redis.close()
+
+
+class AsyncSessions:
+    """Доступ до сховища з корутин: пам'ять процесу читається напряму, SQLite і Redis — у потоці
+    (атрибут blocking сховища), щоб запит до диска чи мережі не зупиняв цикл подій."""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def _call(self, method, *args):
+        if not self.store.blocking:
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+    async def load(self, chat_id):
+        return await self._call(self.store.load, chat_id)
+
+    async def save(self, state):
+        await self._call(self.store.save, state)
+
+    async def delete(self, chat_id):
+        await self._call(self.store.delete, chat_id)
+
+    def close(self):
+        self.store.close()
+
+
+def from_url(url=SESSION_STORE_URL):
+    """Створює сховище за URL: memory://, sqlite:///path/to/sessions.db або redis://host:port/db."""
+    if url.startswith('memory://'):
+        return MemorySessionStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteSessionStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSessionStore(url)
+    raise ValueError(f"Unsupported SESSION_STORE_URL: {url}")
@@ -0,0 +1,46 @@
+import course
+
+# Маршрут уздовж широти 50.45: від стартового кола до фінішного, 0.001° довготи ≈ 71 м
+_COURSE = {
+    'type': 'FeatureCollection',
+    'features': [
+        {'type': 'Feature', 'properties': {'role': 'start', 'radius_m': 50},
+         'geometry': {'type': 'Point', 'coordinates': [30.500, 50.45]}},
+        {'type': 'Feature', 'properties': {'role': 'finish', 'radius_m': 50},
+         'geometry': {'type': 'Point', 'coordinates': [30.530, 50.45]}},
+        {'type': 'Feature', 'properties': {'role': 'checkpoint', 'name': 'Міст', 'radius_m': 50},
+         'geometry': {'type': 'Point', 'coordinates': [30.510, 50.45]}},
+        {'type': 'Feature', 'properties': {'role': 'checkpoint', 'name': 'Парк', 'radius_m': 50},
+         'geometry': {'type': 'Point', 'coordinates': [30.520, 50.45]}},
+        {'type': 'Feature', 'properties': {'role': 'route'},
+         'geometry': {'type': 'LineString', 'coordinates': [[30.500, 50.45], [30.530, 50.45]]}},
+    ],
+}
+
+
+def test_sparse_track_visits_checkpoint_between_points():
+    event_course = course.Course.from_geojson(_COURSE)
+    # Жодна точка не потрапляє в радіус «Мосту», але відрізок між ними проходить через нього
+    check = event_course.check_track([50.45, 50.45, 50.45, 50.45], [30.500, 30.505, 30.515, 30.530])
+    assert check.visited == [0, 1]
+    assert check.missed == []
+    assert check.off_route_points == 0
+
+
+def test_shortcut_misses_checkpoint_and_leaves_route():
+    event_course = course.Course.from_geojson(_COURSE)
+    # Після «Мосту» учасник зрізає на північ (≈1.1 км від маршруту) і оминає «Парк»
+    check = event_course.check_track([50.45, 50.45, 50.46, 50.45], [30.500, 30.512, 30.520, 30.530])
+    assert check.visited == [0]
+    assert check.missed == [1]
+    assert check.off_route_points == 1
+    assert event_course.checkpoints[check.missed[0]].name == 'Парк'
+
+
+def test_zones_allow_for_gps_accuracy():
+    event_course = course.Course.from_geojson(_COURSE)
+    assert event_course.in_start_zone(50.45, 30.5005)
+    # ≈85 м від центру стартового кола: поза радіусом, але в межах заявленої точності
+    assert not event_course.in_start_zone(50.45, 30.5012)
+    assert event_course.in_start_zone(50.45, 30.5012, accuracy=40)
+    assert not event_course.in_finish_zone(50.45, 30.5005)
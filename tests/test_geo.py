@@ -0,0 +1,33 @@
+import numpy as np
+
+import geo
+
+
+def test_same_second_points_are_not_a_teleport():
+    # Старт і перша точка трансляції за 10 м одна від одної з однаковою секундою, далі біг 3 м/с
+    lats = [50.0, 50.00009, 50.00036]
+    lons = [30.0, 30.0, 30.0]
+    times = [1000.0, 1000.0, 1010.0]
+    distance, max_speed, flags = geo.validate_tracks(lats, lons, times, [0])
+    assert np.isclose(distance[0], geo.haversine_km(50.0, 30.0, 50.00036, 30.0))
+    assert max_speed[0] < geo.TELEPORT_SPEED_KMH
+    assert flags[0] == 0
+
+
+def test_jump_within_one_second_is_a_teleport():
+    lats = [50.0, 50.0, 50.01]
+    lons = [30.0, 30.0, 30.0]
+    times = [1000.0, 1010.0, 1010.0]
+    _, max_speed, flags = geo.validate_tracks(lats, lons, times, [0])
+    assert np.isfinite(max_speed[0])
+    assert flags[0] == geo.FLAG_TELEPORT
+
+
+def test_segment_between_tracks_is_ignored():
+    # Другий трек починається далеко від кінця першого і в ту саму секунду
+    lats = [50.0, 50.00009, 51.0, 51.00009]
+    lons = [30.0, 30.0, 30.0, 30.0]
+    times = [1000.0, 1005.0, 1005.0, 1010.0]
+    distance, _, flags = geo.validate_tracks(lats, lons, times, [0, 2])
+    assert np.allclose(distance, [0.01, 0.01], atol=1e-3)
+    assert list(flags) == [0, 0]
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import journal
+from session_store import RunnerState
+
+
+def _update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'text': '/start'}}
+
+
+def _write_journal(path):
+    """Журнал процесу, що впав посеред запису: два оброблені оновлення, одне необроблене й обрізаний рядок."""
+    log = journal.Journal(str(path), sync_interval=60).open()
+    log.received([_update(1, 10), _update(2, 20)], offset=3)
+    token = journal.current_update.set(1)
+    log.record_state(RunnerState(10, step='name', language='uk'))
+    journal.current_update.reset(token)
+    log.done(1)
+    log.record_state(RunnerState(20, step='start', name='Олена', start_time='2026-10-18 09:00:00'))
+    log.received([_update(3, 30)], offset=4)
+    log.sync()
+    log.close()
+    with open(path, 'ab') as f:
+        f.write(json.dumps({'u': 2, 's': [[20, RunnerState(20).dumps(), 0]]}).encode()[:25])
+
+
+def test_replay_and_compact_truncated_journal(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    _write_journal(path)
+
+    log = journal.Journal(str(path), sync_interval=60).open()
+    try:
+        states = {state.chat_id: state for state in log.states()}
+        assert states[10].step == 'name'
+        assert states[20].name == 'Олена'
+        # Позначка обробки оновлення 2 обрізана, тож воно обробляється повторно разом із 3
+        assert [update['update_id'] for update in log.pending()] == [2, 3]
+        assert log.offset == 4
+        # Повторна доставка вже отриманих оновлень, обробленого й необробленого, відкидається
+        assert log.received([_update(1, 10), _update(3, 30)]) == []
+    finally:
+        log.close()
+
+    # Стиснення переписало журнал знімком без обрізаного рядка, і знімок читається так само
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert not any('u' in record for record in records)
+    log = journal.Journal(str(path), sync_interval=60).open()
+    try:
+        assert {state.chat_id for state in log.states()} == {10, 20}
+        assert [update['update_id'] for update in log.pending()] == [2, 3]
+        assert log.offset == 4
+    finally:
+        log.close()
+
+
+def test_journal_refuses_second_process(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    log = journal.Journal(path, sync_interval=60).open()
+    try:
+        with pytest.raises(journal.JournalLocked):
+            journal.Journal(path, sync_interval=60).open()
+    finally:
+        log.close()
+    journal.Journal(path, sync_interval=60).open().close()
+
+
+def test_failed_sync_keeps_update_for_dispatch(tmp_path, monkeypatch):
+    log = journal.Journal(str(tmp_path / 'journal.jsonl'), sync_interval=60).open()
+    try:
+        fresh = log.received([_update(5, 50)])
+
+        def disk_full(fd):
+            raise OSError(28, 'No space left on device')
+
+        monkeypatch.setattr(journal.os, 'fsync', disk_full)
+        assert not log.try_sync()
+        # Оновлення обробляється попри збій запису, а повторна доставка не обробиться вдруге
+        assert [update['update_id'] for update in fresh] == [5]
+        assert log.received([_update(5, 50)]) == []
+    finally:
+        monkeypatch.undo()
+        log.close()
@@ -0,0 +1,33 @@
+import leaderboard
+
+
+def test_record_keeps_best_attempt_and_ties_share_rank():
+    board = leaderboard.Leaderboard(size=2)
+    board.record(1, 10.0, 'Олена К.')
+    board.record(2, 5.0, 'Іван П.')
+    board.record(3, 5.0, 'Марта С.')
+    # Гірша спроба не змінює результат, краща — замінює
+    board.record(1, 7.0, 'Олена К.')
+    board.record(2, 12.0, 'Іван П.')
+
+    assert board.stats(2) == (12.0, 1, 3)
+    assert board.stats(1) == (10.0, 2, 3)
+    board.record(4, 10.0, 'Петро Д.')
+    assert board.stats(1) == (10.0, 2, 4)
+    assert board.stats(4) == (10.0, 2, 4)
+    assert board.stats(3) == (5.0, 4, 4)
+    assert board.stats(99) is None
+    assert len(board) == 4
+    assert board.total_distance == 37.0
+
+
+def test_top_after_replaced_result():
+    board = leaderboard.Leaderboard(size=2)
+    board.replace_all([(1, 21.1, 'Олена К.'), (2, 10.0, 'Іван П.'), (3, 5.0, 'Марта С.')], event_id=7)
+    assert board.event_id == 7
+    assert board.top() == [(21.1, 'Олена К.'), (10.0, 'Іван П.')]
+    # Учасник із топу покращує результат: купа перебудовується без дубля
+    board.record(2, 42.2, 'Іван П.')
+    board.record(3, 15.0, 'Марта С.')
+    assert board.top() == [(42.2, 'Іван П.'), (21.1, 'Олена К.')]
+    assert board.bucket_counts() == [0, 0, 1, 1, 1]
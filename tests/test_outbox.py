@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+
+import outbox
+
+
+def _too_many_requests(error_class, retry_after=1):
+    return error_class('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                             'parameters': {'retry_after': retry_after}})
+
+
+class _Bot:
+    """Перший виклик у чат 1 отримує 429, решта запам'ятовують час і текст."""
+
+    error_class = ApiTelegramException
+
+    def __init__(self):
+        self.sent = []
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def _send(self, chat_id, text):
+        with self._lock:
+            if chat_id == 1 and not self.failed:
+                self.failed = True
+                raise _too_many_requests(self.error_class)
+            self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+    def send_message(self, chat_id, text):
+        return self._send(chat_id, text)
+
+
+class _AsyncBot(_Bot):
+    error_class = AsyncApiTelegramException
+
+    async def send_message(self, chat_id, text):
+        return self._send(chat_id, text)
+
+
+def _check_paused(bot, started):
+    # Після 429 у чат 1 пауза діє на весь бот: чат 2 теж чекає retry_after, порядок у чаті 1 зберігся
+    assert [text for chat_id, text, _ in bot.sent if chat_id == 1] == ['a', 'b']
+    assert all(sent_at - started >= 0.9 for _, _, sent_at in bot.sent)
+
+
+def test_429_pauses_all_chats_and_keeps_order():
+    bot = _Bot()
+    box = outbox.Outbox(bot).start()
+    started = time.monotonic()
+    first = box.send_message(1, 'a')
+    box.send_message(1, 'b')
+    time.sleep(0.1)
+    box.send_message(2, 'c')
+    box.close()
+    assert first.result(timeout=0) == 'a'
+    _check_paused(bot, started)
+
+
+def test_async_429_pauses_all_chats_and_keeps_order():
+    bot = _AsyncBot()
+
+    async def run():
+        box = outbox.AsyncOutbox(bot).start()
+        started = time.monotonic()
+        first = box.send_message(1, 'a')
+        box.send_message(1, 'b')
+        await asyncio.sleep(0.1)
+        box.send_message(2, 'c')
+        await box.close()
+        assert first.result() == 'a'
+        return started
+
+    _check_paused(bot, asyncio.run(run()))
@@ -0,0 +1,54 @@
+import psycopg2
+
+import db
+import result_writer
+
+
+def _row(chat_id, attempt=1, distance=None, event_id=1):
+    row = dict.fromkeys(db.RESULT_COLUMNS)
+    row.update(event_id=event_id, chat_id=chat_id, attempt=attempt, distance_km=distance)
+    return tuple(row[column] for column in db.RESULT_COLUMNS)
+
+
+class _Writer(result_writer.ResultWriter):
+    """ResultWriter без PostgreSQL: рядок чату 13 БД відхиляє, down імітує недоступну БД."""
+
+    def __init__(self, spool_path):
+        super().__init__(None, str(spool_path), retry_interval=0)
+        self.saved = {}
+        self.down = False
+
+    def _resolve_attempts(self, rows):
+        return rows
+
+    def _save_results(self, rows):
+        if self.down:
+            raise psycopg2.OperationalError('server closed the connection')
+        if any(row[1] == 13 for row in rows):
+            raise psycopg2.DataError('value out of range')
+        self.saved.update((row[:3], row) for row in rows)
+
+
+def test_coalesce_keeps_latest_result_per_attempt():
+    rows = [_row(10, distance=1.0), _row(20, distance=2.0), _row(10, distance=3.0), _row(10, attempt=2)]
+    assert result_writer.coalesce(rows) == [_row(20, distance=2.0), _row(10, distance=3.0), _row(10, attempt=2)]
+
+
+def test_rejected_row_does_not_block_batch(tmp_path):
+    writer = _Writer(tmp_path / 'results.csv')
+    writer._flush([_row(chat_id) for chat_id in (11, 12, 13, 14)])
+    assert sorted(key[1] for key in writer.saved) == [11, 12, 14]
+    with open(writer.rejected_path, encoding='utf-8') as f:
+        assert len(f.readlines()) == 2  # заголовок і рядок чату 13
+
+
+def test_spool_is_replayed_before_new_rows(tmp_path):
+    writer = _Writer(tmp_path / 'results.csv')
+    writer.down = True
+    writer._flush([_row(21, distance=1.5)])
+    assert not writer.saved
+    writer.down = False
+    writer._flush([_row(22)])
+    assert sorted(key[1] for key in writer.saved) == [21, 22]
+    assert writer.saved[(1, 21, 1)][db.RESULT_COLUMNS.index('distance_km')] == 1.5
+    assert (tmp_path / 'results.csv').stat().st_size == 0
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from array import array
+from math import radians, sin, cos, sqrt, atan2
+
+from geo import EARTH_RADIUS_KM
+
+TRACK_MIN_STEP_M = float(os.environ.get('TRACK_MIN_STEP_M', 5))  # нижче — GPS-шум на місці
+TRACK_MAX_ACCURACY_M = float(os.environ.get('TRACK_MAX_ACCURACY_M', 50))
+TRACK_TOLERANCE_M = float(os.environ.get('TRACK_TOLERANCE_M', 10))  # допуск спрощення перед записом у БД
+TRACK_PRECISION = 1e5  # ~1 м для координат у закодованому треку
+# Трек без фінішу видаляється через live_period трансляції плюс запас на фінішну геопозицію,
+# але не пізніше, ніж сесія учасника (SESSION_TTL)
+TRACK_EXPIRY_MARGIN = float(os.environ.get('TRACK_EXPIRY_MARGIN', 3600))  # seconds
+TRACK_MAX_AGE = float(os.environ.get('SESSION_TTL', 24 * 3600))  # seconds
+
+
+class Track:
+    """GPS-трек одного забігу у компактних масивах double з накопичуваною дистанцією."""
+
+    __slots__ = ('lats', 'lons', 'times', 'distance_km', '_lat_rad', '_lon_rad', '_cos_lat')
+
+    def __init__(self):
+        self.lats = array('d')
+        self.lons = array('d')
+        self.times = array('d')
+        self.distance_km = 0.0
+        self._lat_rad = self._lon_rad = self._cos_lat = None
+
+    def __len__(self):
+        return len(self.lats)
+
+    def add(self, lat, lon, timestamp, accuracy=None):
+        """Додає точку і збільшує дистанцію на один відрізок; повертає False, якщо точку відкинуто."""
+        if accuracy is not None and accuracy > TRACK_MAX_ACCURACY_M:
+            return False
+        if self.times and timestamp < self.times[-1]:
+            return False
+        lat_rad, lon_rad = radians(lat), radians(lon)
+        cos_lat = cos(lat_rad)
+        if self._lat_rad is not None:
+            # Haversine лише для нового відрізка; cos попередньої точки вже пораховано
+            a = sin((lat_rad - self._lat_rad) / 2)**2 + self._cos_lat * cos_lat * sin((lon_rad - self._lon_rad) / 2)**2
+            step_km = EARTH_RADIUS_KM * 2 * atan2(sqrt(a), sqrt(1 - a))
+            if step_km * 1000 < TRACK_MIN_STEP_M:
+                return False
+            self.distance_km += step_km
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.times.append(timestamp)
+        self._lat_rad, self._lon_rad, self._cos_lat = lat_rad, lon_rad, cos_lat
+        return True
+
+
+def simplify(track, tolerance_m=TRACK_TOLERANCE_M):
+    """Індекси точок, що лишаються після спрощення Дугласа—Пекера (ітеративно, без рекурсії)."""
+    n = len(track)
+    if n <= 2:
+        return list(range(n))
+    # Локальна рівнокутна проєкція в метри достатня для відстаней у межах забігу
+    k = EARTH_RADIUS_KM * 1000 * 3.141592653589793 / 180
+    cos_ref = cos(radians(track.lats[0]))
+    xs = [lon * k * cos_ref for lon in track.lons]
+    ys = [lat * k for lat in track.lats]
+    keep = bytearray(n)
+    keep[0] = keep[n - 1] = 1
+    stack = [(0, n - 1)]
+    tolerance_sq = tolerance_m * tolerance_m
+    while stack:
+        first, last = stack.pop()
+        dx, dy = xs[last] - xs[first], ys[last] - ys[first]
+        length_sq = dx * dx + dy * dy
+        farthest, max_dist_sq = 0, tolerance_sq
+        for i in range(first + 1, last):
+            px, py = xs[i] - xs[first], ys[i] - ys[first]
+            if length_sq:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / length_sq))
+                px, py = px - t * dx, py - t * dy
+            dist_sq = px * px + py * py
+            if dist_sq > max_dist_sq:
+                farthest, max_dist_sq = i, dist_sq
+        if farthest:
+            keep[farthest] = 1
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [i for i in range(n) if keep[i]]
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode(track, indices=None):
+    """Кодує трек у рядок формату Google polyline з третім виміром — секундами від першої точки."""
+    if indices is None:
+        indices = range(len(track))
+    out = []
+    prev = (0, 0, 0)
+    t0 = track.times[0] if len(track) else 0
+    for i in indices:
+        point = (round(track.lats[i] * TRACK_PRECISION), round(track.lons[i] * TRACK_PRECISION),
+                 round(track.times[i] - t0))
+        for value, previous in zip(point, prev):
+            _encode_value(value - previous, out)
+        prev = point
+    return ''.join(out)
+
+
+def decode(encoded, start_timestamp=0.0):
+    """Відновлює Track із рядка, отриманого від encode()."""
+    track = Track()
+    values = []
+    current = shift = 0
+    for char in encoded:
+        b = ord(char) - 63
+        current |= (b & 0x1f) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(current >> 1) if current & 1 else current >> 1)
+            current = shift = 0
+    lat = lon = seconds = 0
+    for i in range(0, len(values) - 2, 3):
+        lat += values[i]
+        lon += values[i + 1]
+        seconds += values[i + 2]
+        track.lats.append(lat / TRACK_PRECISION)
+        track.lons.append(lon / TRACK_PRECISION)
+        track.times.append(start_timestamp + seconds)
+    return track
+
+
+class TrackRegistry:
+    """Активні треки процесу за chat_id; трек без фінішу видаляється після live_period і TRACK_EXPIRY_MARGIN.
+
+    Треки живуть лише в пам'яті процесу: їх немає ні в сховищі сесій, ні в журналі. Після перезапуску
+    (або якщо фініш обробляє інший процес зі спільним сховищем) трек втрачено, і дистанція рахується
+    по прямій від старту, як без трансляції.
+    """
+
+    def __init__(self, margin=TRACK_EXPIRY_MARGIN, max_age=TRACK_MAX_AGE):
+        self.margin = margin
+        self.max_age = max_age
+        self._tracks = {}       # chat_id -> (Track, expires_at)
+        self._lock = threading.Lock()
+        self._next_prune = time.monotonic() + 60
+
+    def start(self, chat_id, live_period=0):
+        track = Track()
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            self._tracks[chat_id] = (track, now + min(live_period + self.margin, self.max_age))
+        return track
+
+    def get(self, chat_id):
+        entry = self._tracks.get(chat_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def pop(self, chat_id):
+        with self._lock:
+            entry = self._tracks.pop(chat_id, None)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, (_, expires_at) in self._tracks.items() if expires_at < now]:
+            del self._tracks[chat_id]
+        self._next_prune = now + 60
+
+    def __len__(self):
+        return len(self._tracks)
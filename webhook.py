@@ -0,0 +1,240 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+import journal
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', os.environ.get('WEBHOOK_PORT', 8443)))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 16))
+MAX_UPDATE_SIZE = 1024 * 1024  # bytes
+
+
+class ChatOrderedExecutor:
+    """Пул потоків, що виконує задачі різних чатів паралельно, а задачі одного чату — строго по черзі."""
+
+    def __init__(self, workers=WEBHOOK_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update-worker')
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, func, *args):
+        if chat_id is None:
+            self._pool.submit(self._run, chat_id, func, args)
+            return
+        with self._lock:
+            pending = self._queues.get(chat_id)
+            if pending is not None:
+                # Для цього чату вже працює обробник, він забере задачу після поточної
+                pending.append((func, args))
+                return
+            self._queues[chat_id] = deque([(func, args)])
+        self._pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                pending = self._queues[chat_id]
+                if not pending:
+                    del self._queues[chat_id]
+                    return
+                func, args = pending.popleft()
+            self._run(chat_id, func, args)
+
+    @staticmethod
+    def _run(chat_id, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception(f"Помилка обробки оновлення для чату {chat_id}")
+
+    def backlog(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._queues.values())
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class ChatOrderedTasks:
+    """Асинхронний відповідник ChatOrderedExecutor: задачі різних чатів виконуються конкурентно,
+    задачі одного чату — строго по черзі. Замість потоку на чат — одна задача asyncio, поки в чату є черга."""
+
+    def __init__(self):
+        self._queues = {}
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def submit(self, chat_id, func, *args):
+        """Планує await func(*args); func — корутинна функція."""
+        if chat_id is None:
+            self._spawn(self._run(chat_id, func, args))
+            return
+        pending = self._queues.get(chat_id)
+        if pending is not None:
+            pending.append((func, args))
+            return
+        self._queues[chat_id] = deque([(func, args)])
+        self._spawn(self._drain(chat_id))
+
+    async def _drain(self, chat_id):
+        pending = self._queues[chat_id]
+        try:
+            while pending:
+                func, args = pending.popleft()
+                await self._run(chat_id, func, args)
+        finally:
+            del self._queues[chat_id]
+
+    @staticmethod
+    async def _run(chat_id, func, args):
+        try:
+            await func(*args)
+        except Exception:
+            logger.exception(f"Помилка обробки оновлення для чату {chat_id}")
+
+    def backlog(self):
+        return sum(len(pending) for pending in self._queues.values())
+
+    async def join(self, timeout=None):
+        """Чекає на обробку вже прийнятих оновлень."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+
+def update_chat_id(update):
+    """Повертає chat_id, за яким упорядковуються оновлення; None для оновлень без чату."""
+    for message in (update.message, update.edited_message):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+
+def parse_update(body):
+    """(JSON-словник, Update) з тіла запиту Telegram або (None, None), якщо тіло некоректне."""
+    try:
+        raw = json.loads(body)
+        return raw, types.Update.de_json(raw)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Некоректне оновлення у webhook: {e}")
+        return None, None
+
+
+def make_handler(bot, executor, update_journal, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    class UpdateHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/healthz':
+                self._reply(200, b'ok')
+            else:
+                self._reply(404, b'not found')
+
+        def do_POST(self):
+            if self.path != path:
+                self._reply(404, b'not found')
+                return
+            token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if secret and not hmac.compare_digest(token, secret):
+                self._reply(403, b'forbidden')
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            if length <= 0 or length > MAX_UPDATE_SIZE:
+                self._reply(400, b'bad request')
+                return
+            raw, update = parse_update(self.rfile.read(length))
+            if update is None:
+                self._reply(400, b'bad request')
+                return
+            if update_journal.received([raw]):
+                # Відповідь 200 підтверджує оновлення, тож спершу воно має потрапити на диск. Якщо запис не
+                # вдався, оновлення все одно обробляється: повторну доставку received() відкине як дублікат
+                update_journal.try_sync()
+                executor.submit(update_chat_id(update), journal.process_update, bot, update_journal, update)
+            # Обробка йде у пулі потоків, Telegram не чекає на неї
+            self._reply(200, b'ok')
+
+        def _reply(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return UpdateHandler
+
+
+class WebhookServer(ThreadingHTTPServer):
+    # Telegram тримає до max_connections=100 одночасних з'єднань; типова черга listen() на 5 їх відкидає
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(bot, executor, update_journal, public_url=None, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Запускає HTTP-сервер webhook; якщо задано public_url, реєструє його у Telegram."""
+    server = WebhookServer((host, port), make_handler(bot, executor, update_journal))
+    if public_url:
+        bot.remove_webhook()
+        bot.set_webhook(url=public_url.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        max_connections=100)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+async def serve_async(bot, tasks, update_journal, public_url=None, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """Webhook для AsyncTeleBot на aiohttp; працює, доки корутину не скасують."""
+    from aiohttp import web
+
+    async def receive_update(request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if WEBHOOK_SECRET and not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403, text='forbidden')
+        length = request.content_length or 0
+        if length <= 0 or length > MAX_UPDATE_SIZE:
+            return web.Response(status=400, text='bad request')
+        raw, update = parse_update(await request.read())
+        if update is None:
+            return web.Response(status=400, text='bad request')
+        if update_journal.received([raw]):
+            await asyncio.to_thread(update_journal.try_sync)
+            tasks.submit(update_chat_id(update), journal.process_update_async, bot, update_journal, update)
+        return web.Response(text='ok')
+
+    async def healthz(request):
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=MAX_UPDATE_SIZE)
+    app.router.add_post(WEBHOOK_PATH, receive_update)
+    app.router.add_get('/healthz', healthz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port, backlog=WebhookServer.request_queue_size).start()
+        if public_url:
+            await bot.remove_webhook()
+            await bot.set_webhook(url=public_url.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  max_connections=100)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()